@@ -1,6 +1,15 @@
 #!/usr/bin/env python3
 
+import collections
+import functools
 import random
+import struct
+from concurrent.futures import Executor, ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 """
 This is an exercise in secure symmetric-key encryption, implemented in pure
@@ -116,6 +125,58 @@ def inv_mix_columns(s):
     mix_columns(s)
 
 
+def _compute_t_tables():
+    """
+    Precomputes the 32-bit T-tables used by the word-oriented engine.
+
+    Each encryption table folds SubBytes, ShiftRows and MixColumns for one
+    row of a column into a single lookup, the decryption tables do the same
+    for the inverse operations. Words are big-endian columns, ie. byte 0 of
+    a column is the most significant byte.
+    """
+    te = [[0] * 256 for _ in range(4)]
+    td = [[0] * 256 for _ in range(4)]
+
+    for x in range(256):
+        s = s_box[x]
+        s2 = xtime(s)
+        s3 = s2 ^ s
+        word = (s2 << 24) | (s << 16) | (s << 8) | s3
+
+        si = inv_s_box[x]
+        si2 = xtime(si)
+        si4 = xtime(si2)
+        si8 = xtime(si4)
+        si9 = si8 ^ si
+        sib = si8 ^ si2 ^ si
+        sid = si8 ^ si4 ^ si
+        sie = si8 ^ si4 ^ si2
+        inv_word = (sie << 24) | (si9 << 16) | (sid << 8) | sib
+
+        # The tables for rows 1 to 3 are byte rotations of the first one.
+        for row in range(4):
+            te[row][x] = word
+            td[row][x] = inv_word
+            word = (word >> 8) | ((word & 0xFF) << 24)
+            inv_word = (inv_word >> 8) | ((inv_word & 0xFF) << 24)
+
+    return tuple(tuple(t) for t in te), tuple(tuple(t) for t in td)
+
+
+(Te0, Te1, Te2, Te3), (Td0, Td1, Td2, Td3) = _compute_t_tables()
+
+
+def inv_mix_column_word(w):
+    """ Applies InvMixColumns to a single big-endian column word. """
+    # Td[i][s_box[x]] is InvMixColumns applied to x alone in row i.
+    return (
+        Td0[s_box[w >> 24]]
+        ^ Td1[s_box[(w >> 16) & 0xFF]]
+        ^ Td2[s_box[(w >> 8) & 0xFF]]
+        ^ Td3[s_box[w & 0xFF]]
+    )
+
+
 r_con = (
     0x00, 0x01, 0x02, 0x04, 0x08, 0x10, 0x20, 0x40,
     0x80, 0x1B, 0x36, 0x6C, 0xD8, 0xAB, 0x4D, 0x9A,
@@ -124,6 +185,11 @@ r_con = (
 )
 
 
+# Fault-free encryption state at the MixColumns input of `round`, see
+# `AES.checkpoint`.
+Checkpoint = collections.namedtuple('Checkpoint', ['round', 'state'])
+
+
 def bytes2matrix(text):
     """ Converts a 16-byte array into a 4x4 matrix.  """
     return [list(text[i:i+4]) for i in range(0, len(text), 4)]
@@ -136,6 +202,8 @@ def xor_bytes(a, b):
     """ Returns a new byte array with the elements xor'ed. """
     return bytes(i^j for i, j in zip(a, b))
 
+CTR_MASK = (1 << 128) - 1
+
 def inc_bytes(a):
     """ Returns a new byte array with the value increment by 1 """
     out = list(a)
@@ -168,11 +236,163 @@ def unpad(plaintext):
     assert all(p == padding_len for p in padding)
     return message
 
+def _unpack_block(block):
+    """ Unpacks a 16-byte block into four big-endian column words. """
+    if not isinstance(block, (bytes, bytearray, memoryview)):
+        block = bytes(block)
+    return struct.unpack('>4I', block)
+
 def split_blocks(message, block_size=16, require_padding=True):
         assert len(message) % block_size == 0 or not require_padding
         return [message[i:i+16] for i in range(0, len(message), block_size)]
 
 
+# Size of the pieces the parallel modes split messages into (a multiple of
+# the block size).
+PARALLEL_CHUNK_SIZE = 1 << 20
+
+def xor_int(a, b):
+    """ Xors two equally long byte strings as big integers, much faster than xor_bytes. """
+    n = len(a)
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(n, 'big')
+
+def _ctr_chunk(cipher, counter, data):
+    """ XORs `data` with the CTR keystream starting at integer `counter`. """
+    n_blocks = (len(data) + 15) // 16
+    counters = b''.join(((counter + i) & CTR_MASK).to_bytes(16, 'big') for i in range(n_blocks))
+    return xor_int(data, cipher.encrypt_blocks(counters)[:len(data)])
+
+def _ecb_chunk(cipher, data, decrypt):
+    return cipher._process_blocks(data, decrypt)
+
+def _cbc_decrypt_chunk(cipher, previous, data):
+    """ CBC decrypts `data`, `previous` being the ciphertext block before it. """
+    return xor_int(cipher.decrypt_blocks(data), previous + data[:-16])
+
+def _run_chunks(task, jobs, out, workers):
+    """
+    Runs `task(*args)` for every `(offset, args)` job and writes each result
+    at `offset` in the preallocated `out` buffer.
+
+    `workers` is None to run in this process, a number of worker processes,
+    or a `concurrent.futures.Executor` to submit the jobs to.
+    """
+    if workers is None or workers == 1:
+        for offset, args in jobs:
+            result = task(*args)
+            out[offset:offset + len(result)] = result
+        return out
+
+    owned = not isinstance(workers, Executor)
+    executor = ProcessPoolExecutor(workers) if owned else workers
+    try:
+        futures = [(offset, executor.submit(task, *args)) for offset, args in jobs]
+        for offset, future in futures:
+            result = future.result()
+            out[offset:offset + len(result)] = result
+    finally:
+        if owned:
+            executor.shutdown()
+
+    return out
+
+
+# Byte index permutations of ShiftRows and InvShiftRows over a flat 16-byte
+# state, where byte 4 * col + row is in column col and row row.
+SHIFT_ROWS_INDEX = [4 * ((col + row) % 4) + row for col in range(4) for row in range(4)]
+INV_SHIFT_ROWS_INDEX = [4 * ((col - row) % 4) + row for col in range(4) for row in range(4)]
+
+if np is not None:
+    _np_s_box = np.array(s_box, dtype=np.uint8)
+    _np_inv_s_box = np.array(inv_s_box, dtype=np.uint8)
+    _np_xtime = np.array([xtime(a) for a in range(256)], dtype=np.uint8)
+
+
+def _np_mix_columns(state):
+    """ Vectorized MixColumns over an (N, 16) uint8 state, in place. """
+    a = state.reshape(-1, 4, 4)
+    t = a[:, :, 0] ^ a[:, :, 1] ^ a[:, :, 2] ^ a[:, :, 3]
+    a ^= t[:, :, None] ^ _np_xtime[a ^ a[:, :, [1, 2, 3, 0]]]
+
+
+def _np_inv_mix_columns(state):
+    """ Vectorized InvMixColumns over an (N, 16) uint8 state, in place. """
+    a = state.reshape(-1, 4, 4)
+    u = _np_xtime[_np_xtime[a[:, :, 0] ^ a[:, :, 2]]]
+    v = _np_xtime[_np_xtime[a[:, :, 1] ^ a[:, :, 3]]]
+    a[:, :, 0] ^= u
+    a[:, :, 2] ^= u
+    a[:, :, 1] ^= v
+    a[:, :, 3] ^= v
+    _np_mix_columns(state)
+
+
+def np_encrypt_blocks(blocks, round_keys):
+    """
+    Encrypts an (N, 16) uint8 array of blocks, every round running over the
+    whole batch at once.
+
+    `round_keys` is an (n_rounds + 1, 16) array of round keys, or an
+    (n_rounds + 1, N, 16) array to use a different key for every block.
+    """
+    n_rounds = len(round_keys) - 1
+    return np_encrypt_from(np_encrypt_until(blocks, round_keys, n_rounds), round_keys, n_rounds)
+
+
+def np_encrypt_until(blocks, round_keys, stop_round):
+    """
+    Runs the encryption of an (N, 16) uint8 array of blocks up to the
+    ShiftRows of round `stop_round` included, ie. up to where the round's
+    MixColumns would run. This is where faults are injected.
+    """
+    state = blocks ^ round_keys[0]
+
+    for i in range(1, stop_round):
+        state = _np_s_box[state][:, SHIFT_ROWS_INDEX]
+        _np_mix_columns(state)
+        state ^= round_keys[i]
+
+    return _np_s_box[state][:, SHIFT_ROWS_INDEX]
+
+
+def np_encrypt_from(state, round_keys, start_round):
+    """
+    Finishes the encryption of a state returned by `np_encrypt_until` for
+    `start_round`. `state` is modified in place.
+    """
+    n_rounds = len(round_keys) - 1
+
+    if start_round < n_rounds:
+        _np_mix_columns(state)
+    state ^= round_keys[start_round]
+
+    for i in range(start_round + 1, n_rounds + 1):
+        state = _np_s_box[state][:, SHIFT_ROWS_INDEX]
+        if i < n_rounds:
+            _np_mix_columns(state)
+        state ^= round_keys[i]
+
+    return state
+
+
+def np_decrypt_blocks(blocks, round_keys):
+    """
+    Decrypts an (N, 16) uint8 array of blocks, the inverse of
+    `np_encrypt_blocks` with the same `round_keys`.
+    """
+    n_rounds = len(round_keys) - 1
+    state = blocks ^ round_keys[n_rounds]
+    state = _np_inv_s_box[state[:, INV_SHIFT_ROWS_INDEX]]
+
+    for i in range(n_rounds - 1, 0, -1):
+        state ^= round_keys[i]
+        _np_inv_mix_columns(state)
+        state = _np_inv_s_box[state[:, INV_SHIFT_ROWS_INDEX]]
+
+    state ^= round_keys[0]
+    return state
+
+
 class AES:
     """
     Class for AES-128 encryption with CBC mode and PKCS#7.
@@ -187,12 +407,56 @@ class AES:
         """
         assert len(master_key) in AES.rounds_by_key_size
         self.n_rounds = AES.rounds_by_key_size[len(master_key)]
-        self._key_matrices = self._expand_key(master_key)
+        self._key_matrices, self._enc_words, self._dec_words = _key_schedule(bytes(master_key))
+        self._np_keys = None
+
+    @classmethod
+    def from_round_keys(cls, round_keys):
+        """
+        Builds the object directly from an expanded key schedule, given as
+        the (n_rounds + 1) * 16 bytes of the round keys (a row of the
+        `expand_keys` output), skipping the key expansion.
+        """
+        round_keys = bytes(round_keys)
+        assert len(round_keys) % 16 == 0 and len(round_keys) // 16 - 1 in cls.rounds_by_key_size.values()
+
+        cipher = cls.__new__(cls)
+        cipher.n_rounds = len(round_keys) // 16 - 1
+        cipher._key_matrices = [bytes2matrix(round_keys[i:i + 16]) for i in range(0, len(round_keys), 16)]
+        cipher._enc_words, cipher._dec_words = cls._pack_round_keys(cipher._key_matrices)
+        cipher._np_keys = None
+        return cipher
+
+    @staticmethod
+    def _pack_round_keys(key_matrices):
+        """
+        Packs the key matrices into flat lists of big-endian column words for
+        the T-table engine.
 
-    def _expand_key(self, master_key):
+        The decryption schedule is in reverse round order, with InvMixColumns
+        applied to the inner round keys (equivalent inverse cipher).
+        """
+        enc_words = [
+            int.from_bytes(bytes(column), 'big')
+            for matrix in key_matrices
+            for column in matrix
+        ]
+
+        n_rounds = len(key_matrices) - 1
+        dec_words = list(enc_words[4 * n_rounds:])
+        for i in range(n_rounds - 1, 0, -1):
+            dec_words.extend(inv_mix_column_word(w) for w in enc_words[4 * i:4 * i + 4])
+        dec_words.extend(enc_words[:4])
+
+        return enc_words, dec_words
+
+    @staticmethod
+    def _expand_key(master_key):
         """
         Expands and returns a list of key matrices for the given master_key.
         """
+        n_rounds = AES.rounds_by_key_size[len(master_key)]
+
         # Initialize round keys with raw key material.
         key_columns = bytes2matrix(master_key)
         iteration_size = len(master_key) // 4
@@ -200,7 +464,7 @@ class AES:
         # Each iteration has exactly as many columns as the key material.
         columns_per_iteration = len(key_columns)
         i = 1
-        while len(key_columns) < (self.n_rounds + 1) * 4:
+        while len(key_columns) < (n_rounds + 1) * 4:
             # Copy previous word.
             word = list(key_columns[-1])
 
@@ -231,30 +495,58 @@ class AES:
         """
         assert len(plaintext) == 16
 
-        plain_state = bytes2matrix(plaintext)
-
-        add_round_key(plain_state, self._key_matrices[0])
-
-        for i in range(1, self.n_rounds):
-            sub_bytes(plain_state)
-            shift_rows(plain_state)
-            mix_columns(plain_state)
-            add_round_key(plain_state, self._key_matrices[i])
-
-        sub_bytes(plain_state)
-        shift_rows(plain_state)
-        add_round_key(plain_state, self._key_matrices[-1])
+        return struct.pack('>4I', *self._encrypt_words(*_unpack_block(plaintext)))
 
-        return matrix2bytes(plain_state)
+    def _encrypt_words(self, s0, s1, s2, s3):
+        """
+        Encrypts a block given as four big-endian column words with the
+        T-table engine, and returns the four output words.
+        """
+        rk = self._enc_words
+        te0, te1, te2, te3 = Te0, Te1, Te2, Te3
+
+        s0 ^= rk[0]
+        s1 ^= rk[1]
+        s2 ^= rk[2]
+        s3 ^= rk[3]
+
+        for i in range(4, 4 * self.n_rounds, 4):
+            t0 = te0[s0 >> 24] ^ te1[(s1 >> 16) & 0xFF] ^ te2[(s2 >> 8) & 0xFF] ^ te3[s3 & 0xFF] ^ rk[i]
+            t1 = te0[s1 >> 24] ^ te1[(s2 >> 16) & 0xFF] ^ te2[(s3 >> 8) & 0xFF] ^ te3[s0 & 0xFF] ^ rk[i + 1]
+            t2 = te0[s2 >> 24] ^ te1[(s3 >> 16) & 0xFF] ^ te2[(s0 >> 8) & 0xFF] ^ te3[s1 & 0xFF] ^ rk[i + 2]
+            t3 = te0[s3 >> 24] ^ te1[(s0 >> 16) & 0xFF] ^ te2[(s1 >> 8) & 0xFF] ^ te3[s2 & 0xFF] ^ rk[i + 3]
+            s0, s1, s2, s3 = t0, t1, t2, t3
+
+        # The last round has no MixColumns.
+        i = 4 * self.n_rounds
+        sb = s_box
+        return (
+            ((sb[s0 >> 24] << 24) | (sb[(s1 >> 16) & 0xFF] << 16) | (sb[(s2 >> 8) & 0xFF] << 8) | sb[s3 & 0xFF]) ^ rk[i],
+            ((sb[s1 >> 24] << 24) | (sb[(s2 >> 16) & 0xFF] << 16) | (sb[(s3 >> 8) & 0xFF] << 8) | sb[s0 & 0xFF]) ^ rk[i + 1],
+            ((sb[s2 >> 24] << 24) | (sb[(s3 >> 16) & 0xFF] << 16) | (sb[(s0 >> 8) & 0xFF] << 8) | sb[s1 & 0xFF]) ^ rk[i + 2],
+            ((sb[s3 >> 24] << 24) | (sb[(s0 >> 16) & 0xFF] << 16) | (sb[(s1 >> 8) & 0xFF] << 8) | sb[s2 & 0xFF]) ^ rk[i + 3],
+        )
 
     def encrypt_block_with_fault(self, plaintext, col, row, val=42):
+        state = self.encrypt_until(plaintext, self.n_rounds - 1)
+        # inject the fault between the last two mix_columns
+        state[col][row] = val
+        return self.encrypt_from(state, self.n_rounds - 1)
+
+    def encrypt_until(self, plaintext, stop_round):
+        """
+        Runs the encryption of a 16 byte long plaintext up to the ShiftRows
+        of round `stop_round` included, ie. up to where the round's
+        MixColumns would run, and returns the state matrix.
+        """
         assert len(plaintext) == 16
+        assert 1 <= stop_round <= self.n_rounds
 
         plain_state = bytes2matrix(plaintext)
 
         add_round_key(plain_state, self._key_matrices[0])
 
-        for i in range(1, self.n_rounds - 1):
+        for i in range(1, stop_round):
             sub_bytes(plain_state)
             shift_rows(plain_state)
             mix_columns(plain_state)
@@ -262,17 +554,46 @@ class AES:
 
         sub_bytes(plain_state)
         shift_rows(plain_state)
-        # inject the fault between the last two mix_columns
-        plain_state[col][row] = val
-        mix_columns(plain_state)
-        add_round_key(plain_state, self._key_matrices[self.n_rounds - 1])
 
-        sub_bytes(plain_state)
-        shift_rows(plain_state)
-        add_round_key(plain_state, self._key_matrices[-1])
+        return plain_state
+
+    def checkpoint(self, plaintext, fault_round):
+        """
+        Runs the fault-free part of the encryption of `plaintext`, up to the
+        MixColumns input of round `fault_round`, and returns it as a
+        lightweight snapshot that `resume` can finish many times.
+        """
+        return Checkpoint(fault_round, matrix2bytes(self.encrypt_until(plaintext, fault_round)))
 
-        return matrix2bytes(plain_state)
+    def resume(self, checkpoint, inject=None):
+        """
+        Finishes an encryption from a `checkpoint` snapshot. `inject`, if
+        given, is called with a fresh copy of the state matrix to fault it in
+        place first.
+        """
+        state = bytes2matrix(checkpoint.state)
+        if inject is not None:
+            inject(state)
+        return self.encrypt_from(state, checkpoint.round)
+
+    def encrypt_from(self, state, start_round):
+        """
+        Finishes the encryption of a state matrix returned by
+        `encrypt_until` for `start_round`, possibly faulted in between.
+        `state` is modified in place.
+        """
+        if start_round < self.n_rounds:
+            mix_columns(state)
+        add_round_key(state, self._key_matrices[start_round])
+
+        for i in range(start_round + 1, self.n_rounds + 1):
+            sub_bytes(state)
+            shift_rows(state)
+            if i < self.n_rounds:
+                mix_columns(state)
+            add_round_key(state, self._key_matrices[i])
 
+        return matrix2bytes(state)
 
     def decrypt_block(self, ciphertext):
         """
@@ -280,197 +601,582 @@ class AES:
         """
         assert len(ciphertext) == 16
 
-        cipher_state = bytes2matrix(ciphertext)
+        return struct.pack('>4I', *self._decrypt_words(*_unpack_block(ciphertext)))
 
-        add_round_key(cipher_state, self._key_matrices[-1])
-        inv_shift_rows(cipher_state)
-        inv_sub_bytes(cipher_state)
+    def _decrypt_words(self, s0, s1, s2, s3):
+        """
+        Decrypts a block given as four big-endian column words with the
+        T-table engine, and returns the four output words.
+        """
+        rk = self._dec_words
+        td0, td1, td2, td3 = Td0, Td1, Td2, Td3
+
+        s0 ^= rk[0]
+        s1 ^= rk[1]
+        s2 ^= rk[2]
+        s3 ^= rk[3]
+
+        for i in range(4, 4 * self.n_rounds, 4):
+            t0 = td0[s0 >> 24] ^ td1[(s3 >> 16) & 0xFF] ^ td2[(s2 >> 8) & 0xFF] ^ td3[s1 & 0xFF] ^ rk[i]
+            t1 = td0[s1 >> 24] ^ td1[(s0 >> 16) & 0xFF] ^ td2[(s3 >> 8) & 0xFF] ^ td3[s2 & 0xFF] ^ rk[i + 1]
+            t2 = td0[s2 >> 24] ^ td1[(s1 >> 16) & 0xFF] ^ td2[(s0 >> 8) & 0xFF] ^ td3[s3 & 0xFF] ^ rk[i + 2]
+            t3 = td0[s3 >> 24] ^ td1[(s2 >> 16) & 0xFF] ^ td2[(s1 >> 8) & 0xFF] ^ td3[s0 & 0xFF] ^ rk[i + 3]
+            s0, s1, s2, s3 = t0, t1, t2, t3
+
+        # The last round has no InvMixColumns.
+        i = 4 * self.n_rounds
+        isb = inv_s_box
+        return (
+            ((isb[s0 >> 24] << 24) | (isb[(s3 >> 16) & 0xFF] << 16) | (isb[(s2 >> 8) & 0xFF] << 8) | isb[s1 & 0xFF]) ^ rk[i],
+            ((isb[s1 >> 24] << 24) | (isb[(s0 >> 16) & 0xFF] << 16) | (isb[(s3 >> 8) & 0xFF] << 8) | isb[s2 & 0xFF]) ^ rk[i + 1],
+            ((isb[s2 >> 24] << 24) | (isb[(s1 >> 16) & 0xFF] << 16) | (isb[(s0 >> 8) & 0xFF] << 8) | isb[s3 & 0xFF]) ^ rk[i + 2],
+            ((isb[s3 >> 24] << 24) | (isb[(s2 >> 16) & 0xFF] << 16) | (isb[(s1 >> 8) & 0xFF] << 8) | isb[s0 & 0xFF]) ^ rk[i + 3],
+        )
+
+    def encrypt_blocks(self, blocks, workers=None):
+        """
+        Encrypts a batch of independent 16-byte blocks (ECB, no padding).
 
-        for i in range(self.n_rounds - 1, 0, -1):
-            add_round_key(cipher_state, self._key_matrices[i])
-            inv_mix_columns(cipher_state)
-            inv_shift_rows(cipher_state)
-            inv_sub_bytes(cipher_state)
+        `blocks` is a contiguous bytes-like object holding N blocks, or an
+        N×16 uint8 NumPy array. The output has the same layout as the input:
+        an array of the same shape, a bytearray, or bytes otherwise.
 
-        add_round_key(cipher_state, self._key_matrices[0])
+        `workers` (a process count or an executor) spreads large batches
+        over several processes.
+        """
+        return self._process_blocks_parallel(blocks, False, workers)
 
-        return matrix2bytes(cipher_state)
+    def decrypt_blocks(self, blocks, workers=None):
+        """
+        Decrypts a batch of independent 16-byte blocks (ECB, no padding).
 
-    def encrypt_cbc(self, plaintext, iv):
+        Accepts and returns the same layouts as `encrypt_blocks`.
         """
-        Encrypts `plaintext` using CBC mode and PKCS#7 padding, with the given
-        initialization vector (iv).
+        return self._process_blocks_parallel(blocks, True, workers)
+
+    def _process_blocks_parallel(self, blocks, decrypt, workers):
+        if workers is None or workers == 1:
+            return self._process_blocks(blocks, decrypt)
+
+        is_array = np is not None and isinstance(blocks, np.ndarray)
+        data = blocks.tobytes() if is_array else bytes(blocks)
+        assert len(data) % 16 == 0
+
+        jobs = [
+            (offset, (self, data[offset:offset + PARALLEL_CHUNK_SIZE], decrypt))
+            for offset in range(0, len(data), PARALLEL_CHUNK_SIZE)
+        ]
+        out = _run_chunks(_ecb_chunk, jobs, bytearray(len(data)), workers)
+
+        if is_array:
+            return np.frombuffer(out, dtype=np.uint8).reshape(blocks.shape)
+        return out if isinstance(blocks, bytearray) else bytes(out)
+
+    def _np_round_keys(self):
         """
-        assert len(iv) == 16
+        Returns the round keys as an (n_rounds + 1, 16) uint8 array.
+        """
+        if self._np_keys is None:
+            keys = bytes(b for matrix in self._key_matrices for column in matrix for b in column)
+            self._np_keys = np.frombuffer(keys, dtype=np.uint8).reshape(-1, 16)
+        return self._np_keys
+
+    def _process_blocks(self, blocks, decrypt):
+        if np is not None and isinstance(blocks, np.ndarray):
+            assert blocks.dtype == np.uint8 and blocks.size % 16 == 0
+            state = np.ascontiguousarray(blocks).reshape(-1, 16)
+            engine = np_decrypt_blocks if decrypt else np_encrypt_blocks
+            return engine(state, self._np_round_keys()).reshape(blocks.shape)
+
+        data = memoryview(blocks).cast('B')
+        assert len(data) % 16 == 0
+
+        if np is not None:
+            state = np.frombuffer(data, dtype=np.uint8).reshape(-1, 16)
+            engine = np_decrypt_blocks if decrypt else np_encrypt_blocks
+            out = engine(state, self._np_round_keys()).tobytes()
+        else:
+            # Pure Python fallback, one block at a time through the T-tables.
+            out = bytearray(len(data))
+            words = self._decrypt_words if decrypt else self._encrypt_words
+            for i, block in enumerate(struct.iter_unpack('>4I', data)):
+                struct.pack_into('>4I', out, 16 * i, *words(*block))
 
-        plaintext = pad(plaintext)
+        return bytearray(out) if isinstance(blocks, bytearray) else bytes(out)
+
+    def encryptor(self, mode, iv):
+        """
+        Returns an incremental encryption context for `mode` ('cbc', 'pcbc',
+        'cfb', 'ofb' or 'ctr') and the given initialization vector (iv).
+        """
+        return MODE_CONTEXTS[mode](self, iv, decrypt=False)
 
-        blocks = []
-        previous = iv
-        for plaintext_block in split_blocks(plaintext):
-            # CBC mode encrypt: encrypt(plaintext_block XOR previous)
-            block = self.encrypt_block(xor_bytes(plaintext_block, previous))
-            blocks.append(block)
-            previous = block
+    def decryptor(self, mode, iv):
+        """
+        Returns an incremental decryption context for `mode` ('cbc', 'pcbc',
+        'cfb', 'ofb' or 'ctr') and the given initialization vector (iv).
+        """
+        return MODE_CONTEXTS[mode](self, iv, decrypt=True)
 
-        return b''.join(blocks)
+    def _one_shot(self, context, data):
+        out = bytearray(len(data) + 32)
+        n = context.update_into(data, out)
+        n += context.finalize_into(memoryview(out)[n:])
+        return bytes(out[:n])
 
-    def decrypt_cbc(self, ciphertext, iv):
+    def encrypt_cbc(self, plaintext, iv):
+        """
+        Encrypts `plaintext` using CBC mode and PKCS#7 padding, with the given
+        initialization vector (iv).
+        """
+        return self._one_shot(self.encryptor('cbc', iv), plaintext)
+
+    def decrypt_cbc(self, ciphertext, iv, workers=None):
         """
         Decrypts `ciphertext` using CBC mode and PKCS#7 padding, with the given
         initialization vector (iv).
+
+        Blocks decrypt independently, so `workers` (a process count or an
+        executor) can split the work over several processes.
         """
         assert len(iv) == 16
+        assert len(ciphertext) % 16 == 0
 
-        blocks = []
-        previous = iv
-        for ciphertext_block in split_blocks(ciphertext):
-            # CBC mode decrypt: previous XOR decrypt(ciphertext)
-            blocks.append(xor_bytes(previous, self.decrypt_block(ciphertext_block)))
-            previous = ciphertext_block
+        # CBC mode decrypt: previous XOR decrypt(ciphertext)
+        ciphertext = bytes(ciphertext)
+        jobs = [
+            (offset, (self, ciphertext[offset - 16:offset] if offset else bytes(iv),
+                      ciphertext[offset:offset + PARALLEL_CHUNK_SIZE]))
+            for offset in range(0, len(ciphertext), PARALLEL_CHUNK_SIZE)
+        ]
+        out = _run_chunks(_cbc_decrypt_chunk, jobs, bytearray(len(ciphertext)), workers)
 
-        return unpad(b''.join(blocks))
+        return unpad(bytes(out))
 
     def encrypt_pcbc(self, plaintext, iv):
         """
         Encrypts `plaintext` using PCBC mode and PKCS#7 padding, with the given
         initialization vector (iv).
         """
-        assert len(iv) == 16
-
-        plaintext = pad(plaintext)
-
-        blocks = []
-        prev_ciphertext = iv
-        prev_plaintext = bytes(16)
-        for plaintext_block in split_blocks(plaintext):
-            # PCBC mode encrypt: encrypt(plaintext_block XOR (prev_ciphertext XOR prev_plaintext))
-            ciphertext_block = self.encrypt_block(xor_bytes(plaintext_block, xor_bytes(prev_ciphertext, prev_plaintext)))
-            blocks.append(ciphertext_block)
-            prev_ciphertext = ciphertext_block
-            prev_plaintext = plaintext_block
-
-        return b''.join(blocks)
+        return self._one_shot(self.encryptor('pcbc', iv), plaintext)
 
     def decrypt_pcbc(self, ciphertext, iv):
         """
         Decrypts `ciphertext` using PCBC mode and PKCS#7 padding, with the given
         initialization vector (iv).
         """
-        assert len(iv) == 16
-
-        blocks = []
-        prev_ciphertext = iv
-        prev_plaintext = bytes(16)
-        for ciphertext_block in split_blocks(ciphertext):
-            # PCBC mode decrypt: (prev_plaintext XOR prev_ciphertext) XOR decrypt(ciphertext_block)
-            plaintext_block = xor_bytes(xor_bytes(prev_ciphertext, prev_plaintext), self.decrypt_block(ciphertext_block))
-            blocks.append(plaintext_block)
-            prev_ciphertext = ciphertext_block
-            prev_plaintext = plaintext_block
-
-        return unpad(b''.join(blocks))
+        return self._one_shot(self.decryptor('pcbc', iv), ciphertext)
 
     def encrypt_cfb(self, plaintext, iv):
         """
         Encrypts `plaintext` with the given initialization vector (iv).
         """
-        assert len(iv) == 16
-
-        blocks = []
-        prev_ciphertext = iv
-        for plaintext_block in split_blocks(plaintext, require_padding=False):
-            # CFB mode encrypt: plaintext_block XOR encrypt(prev_ciphertext)
-            ciphertext_block = xor_bytes(plaintext_block, self.encrypt_block(prev_ciphertext))
-            blocks.append(ciphertext_block)
-            prev_ciphertext = ciphertext_block
-
-        return b''.join(blocks)
+        return self._one_shot(self.encryptor('cfb', iv), plaintext)
 
     def decrypt_cfb(self, ciphertext, iv):
         """
         Decrypts `ciphertext` with the given initialization vector (iv).
         """
-        assert len(iv) == 16
-
-        blocks = []
-        prev_ciphertext = iv
-        for ciphertext_block in split_blocks(ciphertext, require_padding=False):
-            # CFB mode decrypt: ciphertext XOR decrypt(prev_ciphertext)
-            plaintext_block = xor_bytes(ciphertext_block, self.encrypt_block(prev_ciphertext))
-            blocks.append(plaintext_block)
-            prev_ciphertext = ciphertext_block
-
-        return b''.join(blocks)
+        return self._one_shot(self.decryptor('cfb', iv), ciphertext)
 
     def encrypt_ofb(self, plaintext, iv):
         """
         Encrypts `plaintext` using OFB mode initialization vector (iv).
         """
-        assert len(iv) == 16
-
-        blocks = []
-        previous = iv
-        for plaintext_block in split_blocks(plaintext, require_padding=False):
-            # OFB mode encrypt: plaintext_block XOR encrypt(previous)
-            block = self.encrypt_block(previous)
-            ciphertext_block = xor_bytes(plaintext_block, block)
-            blocks.append(ciphertext_block)
-            previous = block
-
-        return b''.join(blocks)
+        return self._one_shot(self.encryptor('ofb', iv), plaintext)
 
     def decrypt_ofb(self, ciphertext, iv):
         """
         Decrypts `ciphertext` using OFB mode initialization vector (iv).
         """
-        assert len(iv) == 16
+        return self._one_shot(self.decryptor('ofb', iv), ciphertext)
 
-        blocks = []
-        previous = iv
-        for ciphertext_block in split_blocks(ciphertext, require_padding=False):
-            # OFB mode decrypt: ciphertext XOR encrypt(previous)
-            block = self.encrypt_block(previous)
-            plaintext_block = xor_bytes(ciphertext_block, block)
-            blocks.append(plaintext_block)
-            previous = block
+    def encrypt_ctr(self, plaintext, iv, workers=None):
+        """
+        Encrypts `plaintext` using CTR mode with the given nounce/IV.
 
-        return b''.join(blocks)
+        `workers` (a process count or an executor) splits the message in
+        chunks encrypted by several processes.
+        """
+        return self._ctr(plaintext, iv, workers)
 
-    def encrypt_ctr(self, plaintext, iv):
+    def decrypt_ctr(self, ciphertext, iv, workers=None):
         """
-        Encrypts `plaintext` using CTR mode with the given nounce/IV.
+        Decrypts `ciphertext` using CTR mode with the given nounce/IV.
+
+        `workers` (a process count or an executor) splits the message in
+        chunks decrypted by several processes.
         """
+        return self._ctr(ciphertext, iv, workers)
+
+    def _ctr(self, data, iv, workers):
         assert len(iv) == 16
 
-        blocks = []
-        nonce = iv
-        for plaintext_block in split_blocks(plaintext, require_padding=False):
-            # CTR mode encrypt: plaintext_block XOR encrypt(nonce)
-            block = xor_bytes(plaintext_block, self.encrypt_block(nonce))
-            blocks.append(block)
-            nonce = inc_bytes(nonce)
+        # CTR mode: data XOR encrypt(nonce), the nonce of each chunk being
+        # directly derived from its offset.
+        data = bytes(data)
+        counter = int.from_bytes(iv, 'big')
+        jobs = [
+            (offset, (self, counter + offset // 16, data[offset:offset + PARALLEL_CHUNK_SIZE]))
+            for offset in range(0, len(data), PARALLEL_CHUNK_SIZE)
+        ]
+        return bytes(_run_chunks(_ctr_chunk, jobs, bytearray(len(data)), workers))
+
+
+# Number of expanded key schedules kept by `_key_schedule`.
+KEY_CACHE_SIZE = 4096
 
-        return b''.join(blocks)
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def _key_schedule(master_key):
+    """
+    Returns the key matrices and the packed encryption and decryption round
+    keys for `master_key`, caching the most recently used schedules.
+    """
+    key_matrices = AES._expand_key(master_key)
+    return (key_matrices,) + AES._pack_round_keys(key_matrices)
+
+
+def expand_keys(master_keys):
+    """
+    Expands N master keys of the same size at once.
+
+    `master_keys` is an (N, key_size) uint8 array or a sequence of N keys.
+    With NumPy, returns an (N, n_rounds + 1, 16) uint8 array of round keys,
+    computed for all the keys at once. Without it, returns a list of N byte
+    strings of (n_rounds + 1) * 16 bytes.
+    Either can be given to `encrypt_block_many_keys` or, row by row, to
+    `AES.from_round_keys`.
+    """
+    if np is None:
+        return [
+            b''.join(matrix2bytes([list(column) for column in matrix]) for matrix in _key_schedule(bytes(key))[0])
+            for key in master_keys
+        ]
+
+    if isinstance(master_keys, np.ndarray):
+        keys = np.ascontiguousarray(master_keys, dtype=np.uint8)
+    else:
+        keys = np.frombuffer(b''.join(bytes(k) for k in master_keys), dtype=np.uint8)
+    key_size = keys.shape[-1] if keys.ndim == 2 else len(master_keys[0])
+    assert key_size in AES.rounds_by_key_size
+    keys = keys.reshape(-1, key_size)
+
+    n_rounds = AES.rounds_by_key_size[key_size]
+    iteration_size = key_size // 4
+    columns = np.empty((len(keys), (n_rounds + 1) * 4, 4), dtype=np.uint8)
+    columns[:, :iteration_size] = keys.reshape(-1, iteration_size, 4)
+
+    # Same schedule as `AES._expand_key`, each step running over all keys.
+    for i in range(iteration_size, (n_rounds + 1) * 4):
+        word = columns[:, i - 1]
+        if i % iteration_size == 0:
+            word = _np_s_box[word[:, [1, 2, 3, 0]]]
+            word[:, 0] ^= r_con[i // iteration_size]
+        elif key_size == 32 and i % iteration_size == 4:
+            word = _np_s_box[word]
+        columns[:, i] = word ^ columns[:, i - iteration_size]
+
+    return columns.reshape(len(keys), n_rounds + 1, 16)
+
+
+def encrypt_block_many_keys(plaintext, round_keys):
+    """
+    Encrypts with N keys expanded by `expand_keys`, either the same 16-byte
+    `plaintext` under every key, or one block per key when `plaintext` holds
+    N blocks.
+
+    Returns an (N, 16) uint8 array with NumPy, a list of N blocks otherwise.
+    """
+    if np is None:
+        plaintext = bytes(plaintext)
+        blocks = [plaintext] * len(round_keys) if len(plaintext) == 16 else split_blocks(plaintext)
+        assert len(blocks) == len(round_keys)
+        return [AES.from_round_keys(rk).encrypt_block(block) for rk, block in zip(round_keys, blocks)]
+
+    if isinstance(plaintext, np.ndarray):
+        blocks = plaintext.reshape(-1, 16)
+    else:
+        blocks = np.frombuffer(bytes(plaintext), dtype=np.uint8).reshape(-1, 16)
+    assert len(blocks) in (1, len(round_keys))
+
+    # np_encrypt_blocks wants the round index first.
+    round_keys = round_keys.transpose(1, 0, 2)
+    return np_encrypt_blocks(np.broadcast_to(blocks, round_keys.shape[1:]), round_keys)
+
+
+def previous_round_key(round_key, round):
+    """
+    Inverts one step of the AES-128 key schedule: returns the 16-byte key of
+    round `round - 1` from the key of round `round` (1 to 10).
+    """
+    assert len(round_key) == 16 and 1 <= round <= 10
 
-    def decrypt_ctr(self, ciphertext, iv):
+    words = [bytes(round_key[i:i+4]) for i in range(0, 16, 4)]
+    previous = [None] * 4
+    for i in (3, 2, 1):
+        previous[i] = xor_bytes(words[i], words[i - 1])
+
+    word = [s_box[b] for b in previous[3][1:] + previous[3][:1]]
+    word[0] ^= r_con[round]
+    previous[0] = xor_bytes(words[0], word)
+
+    return b''.join(previous)
+
+
+def reverse_key_schedule(round_key, round=10):
+    """
+    Returns the AES-128 master key from the 16-byte key of round `round`.
+    """
+    for i in range(round, 0, -1):
+        round_key = previous_round_key(round_key, i)
+
+    return bytes(round_key)
+
+
+def reverse_key_schedules(round_keys, round=10):
+    """
+    Runs `reverse_key_schedule` for N round keys at once.
+
+    `round_keys` is an (N, 16) uint8 array or a sequence of N keys. With
+    NumPy, returns an (N, 16) uint8 array of master keys, a list of N byte
+    strings otherwise. Either can be given to `expand_keys`.
+    """
+    if np is None:
+        return [reverse_key_schedule(key, round) for key in round_keys]
+
+    if isinstance(round_keys, np.ndarray):
+        words = np.ascontiguousarray(round_keys, dtype=np.uint8).reshape(-1, 4, 4)
+    else:
+        words = np.frombuffer(b''.join(bytes(k) for k in round_keys), dtype=np.uint8).reshape(-1, 4, 4)
+
+    # Same steps as `previous_round_key`, each one running over all keys.
+    for i in range(round, 0, -1):
+        previous = np.empty_like(words)
+        previous[:, 1:] = words[:, 1:] ^ words[:, :-1]
+        word = _np_s_box[previous[:, 3][:, [1, 2, 3, 0]]]
+        word[:, 0] ^= r_con[i]
+        previous[:, 0] = words[:, 0] ^ word
+        words = previous
+
+    return words.reshape(-1, 16)
+
+
+
+class ModeContext:
+    """
+    Incremental encryption or decryption with a block cipher mode. Create
+    them with `AES.encryptor` and `AES.decryptor`.
+
+    Input is buffered until whole blocks are available, so `update` can be
+    fed chunks of any size. `finalize` processes the remaining bytes (and
+    the PKCS#7 padding for CBC and PCBC) and must be called once, last.
+    """
+    padded = False
+
+    def __init__(self, cipher, iv, decrypt):
+        assert len(iv) == 16
+        self._cipher = cipher
+        self._decrypt = decrypt
+        self._pending = bytearray()
+        self._finalized = False
+
+    def update(self, data):
         """
-        Decrypts `ciphertext` using CTR mode with the given nounce/IV.
+        Processes `data` and returns the output for all the blocks completed
+        so far.
         """
-        assert len(iv) == 16
+        out = bytearray(len(self._pending) + len(data))
+        n = self.update_into(data, out)
+        return bytes(out[:n])
+
+    def update_into(self, data, out):
+        """
+        Like `update`, but writes the output into the writable buffer `out`
+        and returns the number of bytes written. `out` must have room for
+        len(data) + 15 bytes.
+        """
+        assert not self._finalized
+        self._pending += data
+        n = len(self._pending) // 16 * 16
+
+        # Padded decryption holds the last block back, it may be the padding.
+        if self.padded and self._decrypt and n and n == len(self._pending):
+            n -= 16
 
-        blocks = []
-        nonce = iv
-        for ciphertext_block in split_blocks(ciphertext, require_padding=False):
-            # CTR mode decrypt: ciphertext XOR encrypt(nonce)
-            block = xor_bytes(ciphertext_block, self.encrypt_block(nonce))
-            blocks.append(block)
-            nonce = inc_bytes(nonce)
+        if n == 0:
+            return 0
+
+        assert len(out) >= n
+        blocks = bytes(self._pending[:n])
+        del self._pending[:n]
+        self._process(blocks, memoryview(out)[:n])
+        return n
+
+    def finalize(self):
+        """
+        Processes the buffered bytes and returns the last piece of output.
+        """
+        out = bytearray(32)
+        n = self.finalize_into(out)
+        return bytes(out[:n])
+
+    def finalize_into(self, out):
+        """
+        Like `finalize`, but writes the output into the writable buffer `out`
+        (of at least 32 bytes) and returns the number of bytes written.
+        """
+        assert not self._finalized
+        self._finalized = True
+        tail = bytes(self._pending)
+        self._pending.clear()
+
+        if self.padded and self._decrypt:
+            assert len(tail) == 16
+            block = bytearray(16)
+            self._process(tail, memoryview(block))
+            message = unpad(block)
+            out[:len(message)] = message
+            return len(message)
+
+        if self.padded:
+            tail = pad(tail)
+            self._process(tail, memoryview(out)[:len(tail)])
+            return len(tail)
+
+        # Stream modes: a short last block only uses part of a keystream
+        # block, so process it zero-padded and truncate.
+        if tail:
+            block = bytearray(16)
+            self._process(tail + bytes(16 - len(tail)), memoryview(block))
+            out[:len(tail)] = block[:len(tail)]
+        return len(tail)
+
+    def _process(self, blocks, out):
+        """
+        Processes `blocks`, a whole number of 16-byte blocks, writing the
+        result into `out`.
+        """
+        raise NotImplementedError
+
+
+class CBCContext(ModeContext):
+    padded = True
+
+    def __init__(self, cipher, iv, decrypt):
+        super().__init__(cipher, iv, decrypt)
+        self._previous = bytes(iv)
+
+    def _process(self, blocks, out):
+        if self._decrypt:
+            # CBC mode decrypt: previous XOR decrypt(ciphertext)
+            out[:] = _cbc_decrypt_chunk(self._cipher, self._previous, blocks)
+            self._previous = blocks[-16:]
+            return
+
+        # CBC mode encrypt: encrypt(plaintext_block XOR previous)
+        encrypt = self._cipher._encrypt_words
+        x0, x1, x2, x3 = _unpack_block(self._previous)
+        for i, (p0, p1, p2, p3) in enumerate(struct.iter_unpack('>4I', blocks)):
+            x0, x1, x2, x3 = encrypt(p0 ^ x0, p1 ^ x1, p2 ^ x2, p3 ^ x3)
+            struct.pack_into('>4I', out, 16 * i, x0, x1, x2, x3)
+        self._previous = struct.pack('>4I', x0, x1, x2, x3)
+
+
+class PCBCContext(ModeContext):
+    padded = True
+
+    def __init__(self, cipher, iv, decrypt):
+        super().__init__(cipher, iv, decrypt)
+        # prev_ciphertext XOR prev_plaintext, the plaintext before the first
+        # block being all zeros.
+        self._chain = _unpack_block(iv)
+
+    def _process(self, blocks, out):
+        x0, x1, x2, x3 = self._chain
+
+        if self._decrypt:
+            # PCBC mode decrypt: (prev_plaintext XOR prev_ciphertext) XOR decrypt(ciphertext_block)
+            decrypt = self._cipher._decrypt_words
+            for i, (c0, c1, c2, c3) in enumerate(struct.iter_unpack('>4I', blocks)):
+                d0, d1, d2, d3 = decrypt(c0, c1, c2, c3)
+                p0, p1, p2, p3 = d0 ^ x0, d1 ^ x1, d2 ^ x2, d3 ^ x3
+                struct.pack_into('>4I', out, 16 * i, p0, p1, p2, p3)
+                x0, x1, x2, x3 = c0 ^ p0, c1 ^ p1, c2 ^ p2, c3 ^ p3
+        else:
+            # PCBC mode encrypt: encrypt(plaintext_block XOR (prev_ciphertext XOR prev_plaintext))
+            encrypt = self._cipher._encrypt_words
+            for i, (p0, p1, p2, p3) in enumerate(struct.iter_unpack('>4I', blocks)):
+                c0, c1, c2, c3 = encrypt(p0 ^ x0, p1 ^ x1, p2 ^ x2, p3 ^ x3)
+                struct.pack_into('>4I', out, 16 * i, c0, c1, c2, c3)
+                x0, x1, x2, x3 = c0 ^ p0, c1 ^ p1, c2 ^ p2, c3 ^ p3
+
+        self._chain = (x0, x1, x2, x3)
+
+
+class CFBContext(ModeContext):
+    def __init__(self, cipher, iv, decrypt):
+        super().__init__(cipher, iv, decrypt)
+        self._previous = bytes(iv)
+
+    def _process(self, blocks, out):
+        if self._decrypt:
+            # CFB mode decrypt: ciphertext XOR encrypt(prev_ciphertext), all
+            # the previous ciphertexts are known so this runs as one batch.
+            keystream = self._cipher.encrypt_blocks(self._previous + blocks[:-16])
+            out[:] = xor_int(blocks, keystream)
+            self._previous = blocks[-16:]
+            return
+
+        # CFB mode encrypt: plaintext_block XOR encrypt(prev_ciphertext)
+        encrypt = self._cipher._encrypt_words
+        x0, x1, x2, x3 = _unpack_block(self._previous)
+        for i, (p0, p1, p2, p3) in enumerate(struct.iter_unpack('>4I', blocks)):
+            k0, k1, k2, k3 = encrypt(x0, x1, x2, x3)
+            x0, x1, x2, x3 = p0 ^ k0, p1 ^ k1, p2 ^ k2, p3 ^ k3
+            struct.pack_into('>4I', out, 16 * i, x0, x1, x2, x3)
+        self._previous = struct.pack('>4I', x0, x1, x2, x3)
+
+
+class OFBContext(ModeContext):
+    def __init__(self, cipher, iv, decrypt):
+        super().__init__(cipher, iv, decrypt)
+        self._keystream = _unpack_block(iv)
+
+    def _process(self, blocks, out):
+        # OFB mode: data XOR encrypt(previous keystream block), the same in
+        # both directions.
+        encrypt = self._cipher._encrypt_words
+        k0, k1, k2, k3 = self._keystream
+        for i, (d0, d1, d2, d3) in enumerate(struct.iter_unpack('>4I', blocks)):
+            k0, k1, k2, k3 = encrypt(k0, k1, k2, k3)
+            struct.pack_into('>4I', out, 16 * i, d0 ^ k0, d1 ^ k1, d2 ^ k2, d3 ^ k3)
+        self._keystream = (k0, k1, k2, k3)
+
+
+class CTRContext(ModeContext):
+    def __init__(self, cipher, iv, decrypt):
+        super().__init__(cipher, iv, decrypt)
+        self._counter = int.from_bytes(iv, 'big')
+
+    def _process(self, blocks, out):
+        # CTR mode: data XOR encrypt(nonce), the same in both directions.
+        out[:] = _ctr_chunk(self._cipher, self._counter, blocks)
+        self._counter += len(blocks) // 16
+
+
+MODE_CONTEXTS = {
+    'cbc': CBCContext,
+    'pcbc': PCBCContext,
+    'cfb': CFBContext,
+    'ofb': OFBContext,
+    'ctr': CTRContext,
+}
 
-        return b''.join(blocks)
 
 
 import os
+import shutil
+import tempfile
 from hashlib import pbkdf2_hmac
 from hmac import new as new_hmac, compare_digest
 
@@ -508,7 +1214,9 @@ def encrypt(key, plaintext, workload=100000):
     salt = os.urandom(SALT_SIZE)
     key, hmac_key, iv = get_key_iv(key, salt, workload)
     ciphertext = AES(key).encrypt_cbc(plaintext, iv)
-    hmac = new_hmac(hmac_key, salt + ciphertext, 'sha256').digest()
+    hmac = new_hmac(hmac_key, salt, 'sha256')
+    hmac.update(ciphertext)
+    hmac = hmac.digest()
     assert len(hmac) == HMAC_SIZE
 
     return hmac + salt + ciphertext
@@ -536,12 +1244,168 @@ def decrypt(key, ciphertext, workload=100000):
     salt, ciphertext = ciphertext[:SALT_SIZE], ciphertext[SALT_SIZE:]
     key, hmac_key, iv = get_key_iv(key, salt, workload)
 
-    expected_hmac = new_hmac(hmac_key, salt + ciphertext, 'sha256').digest()
-    assert compare_digest(hmac, expected_hmac), 'Ciphertext corrupted or tampered.'
+    expected_hmac = new_hmac(hmac_key, salt, 'sha256')
+    expected_hmac.update(ciphertext)
+    assert compare_digest(hmac, expected_hmac.digest()), 'Ciphertext corrupted or tampered.'
 
     return AES(key).decrypt_cbc(ciphertext, iv)
 
 
+class Session:
+    """
+    Encrypts and decrypts many messages under one password, stretching it
+    with PBKDF2 only once.
+
+    Messages are `hmac + salt + iv + ciphertext`, the salt being the one of
+    the session and the IV being random for each message. This is not the
+    format of `encrypt`, which derives the IV from a salt of its own.
+    """
+    def __init__(self, key, salt=None, workload=100000):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+
+        self.salt = os.urandom(SALT_SIZE) if salt is None else bytes(salt)
+        assert len(self.salt) == SALT_SIZE
+        aes_key, self._hmac_key, _ = get_key_iv(key, self.salt, workload)
+        self._cipher = AES(aes_key)
+
+    def _hmac(self, iv, ciphertext):
+        hmac = new_hmac(self._hmac_key, self.salt, 'sha256')
+        hmac.update(iv)
+        hmac.update(ciphertext)
+        return hmac.digest()
+
+    def encrypt(self, plaintext):
+        """
+        Encrypts `plaintext` with the session key and a fresh IV.
+        """
+        if isinstance(plaintext, str):
+            plaintext = plaintext.encode('utf-8')
+
+        iv = os.urandom(IV_SIZE)
+        ciphertext = self._cipher.encrypt_cbc(plaintext, iv)
+        return self._hmac(iv, ciphertext) + self.salt + iv + ciphertext
+
+    def decrypt(self, ciphertext):
+        """
+        Decrypts a message produced by `encrypt` on a session with the same
+        password and salt.
+        """
+        header_size = HMAC_SIZE + SALT_SIZE + IV_SIZE
+        assert len(ciphertext) % 16 == 0, "Ciphertext must be made of full 16-byte blocks."
+        assert len(ciphertext) >= header_size + 16, "Ciphertext too short."
+
+        view = memoryview(ciphertext)
+        hmac = view[:HMAC_SIZE]
+        salt = view[HMAC_SIZE:HMAC_SIZE + SALT_SIZE]
+        iv = view[HMAC_SIZE + SALT_SIZE:header_size]
+        ciphertext = view[header_size:]
+
+        assert salt == self.salt, 'Message encrypted under another session salt.'
+        assert compare_digest(hmac, self._hmac(iv, ciphertext)), 'Ciphertext corrupted or tampered.'
+
+        return self._cipher.decrypt_cbc(ciphertext, iv)
+
+
+def decrypt_many(key, ciphertexts, workload=100000):
+    """
+    Decrypts a list of `Session` messages, possibly from several sessions,
+    stretching `key` only once per distinct salt. Returns the plaintexts in
+    the same order.
+    """
+    sessions = {}
+    plaintexts = []
+
+    for ciphertext in ciphertexts:
+        salt = bytes(ciphertext[HMAC_SIZE:HMAC_SIZE + SALT_SIZE])
+        if salt not in sessions:
+            sessions[salt] = Session(key, salt, workload)
+        plaintexts.append(sessions[salt].decrypt(ciphertext))
+
+    return plaintexts
+
+
+# Size of the chunks read by `encrypt_stream` and `decrypt_stream`.
+STREAM_CHUNK_SIZE = 1 << 16
+
+def _read_chunks(source, chunk_size):
+    return iter(lambda: source.read(chunk_size), b'')
+
+def encrypt_stream(key, source, destination, workload=100000, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Streaming version of `encrypt`: reads the plaintext from the binary file
+    `source` and writes the same output format to `destination`, in bounded
+    memory.
+    """
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+
+    salt = os.urandom(SALT_SIZE)
+    key, hmac_key, iv = get_key_iv(key, salt, workload)
+    hmac = new_hmac(hmac_key, salt, 'sha256')
+    encryptor = AES(key).encryptor('cbc', iv)
+
+    # The HMAC comes first in the output but covers the whole ciphertext, so
+    # the ciphertext is spooled (to disk past a few chunks) until it is known.
+    with tempfile.SpooledTemporaryFile(max_size=16 * chunk_size) as spool:
+        for chunk in _read_chunks(source, chunk_size):
+            block = encryptor.update(chunk)
+            hmac.update(block)
+            spool.write(block)
+        block = encryptor.finalize()
+        hmac.update(block)
+        spool.write(block)
+
+        destination.write(hmac.digest())
+        destination.write(salt)
+        spool.seek(0)
+        shutil.copyfileobj(spool, destination, chunk_size)
+
+
+def decrypt_stream(key, source, destination, workload=100000, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Streaming version of `decrypt`: reads the output of `encrypt` (or
+    `encrypt_stream`) from the binary file `source` and writes the plaintext
+    to `destination`, in bounded memory.
+
+    The HMAC is verified before any plaintext is written.
+    """
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+
+    header = source.read(HMAC_SIZE + SALT_SIZE)
+    assert len(header) == HMAC_SIZE + SALT_SIZE, 'Ciphertext too short.'
+    hmac, salt = header[:HMAC_SIZE], header[HMAC_SIZE:]
+    key, hmac_key, iv = get_key_iv(key, salt, workload)
+    expected_hmac = new_hmac(hmac_key, salt, 'sha256')
+
+    # Seekable sources are simply read twice, others are spooled during the
+    # HMAC pass.
+    spool = None if source.seekable() else tempfile.SpooledTemporaryFile(max_size=16 * chunk_size)
+    ciphertext = source if spool is None else spool
+    start = ciphertext.tell()
+
+    try:
+        size = 0
+        for chunk in _read_chunks(source, chunk_size):
+            expected_hmac.update(chunk)
+            size += len(chunk)
+            if spool is not None:
+                spool.write(chunk)
+
+        assert size % 16 == 0 and size >= 16, 'Ciphertext must be made of full 16-byte blocks.'
+        assert compare_digest(hmac, expected_hmac.digest()), 'Ciphertext corrupted or tampered.'
+
+        ciphertext.seek(start)
+        decryptor = AES(key).decryptor('cbc', iv)
+        for chunk in _read_chunks(ciphertext, chunk_size):
+            destination.write(decryptor.update(chunk))
+        destination.write(decryptor.finalize())
+    finally:
+        if spool is not None:
+            spool.close()
+
+
 def benchmark():
     key = b'P' * 16
     message = b'M' * 16
@@ -554,7 +1418,6 @@ __all__ = [encrypt, decrypt, AES]
 if __name__ == '__main__':
     import sys
     write = lambda b: sys.stdout.buffer.write(b)
-    read = lambda: sys.stdin.buffer.read()
 
     if len(sys.argv) < 2:
         print('Usage: ./aes.py encrypt "key" "message"')
@@ -565,15 +1428,22 @@ if __name__ == '__main__':
         benchmark()
         exit()
     elif len(sys.argv) == 3:
-        text = read()
+        # Stream stdin to stdout.
+        text = None
     elif len(sys.argv) > 3:
         text = ' '.join(sys.argv[2:])
 
     if 'encrypt'.startswith(sys.argv[1]):
-        write(encrypt(sys.argv[2], text))
+        if text is None:
+            encrypt_stream(sys.argv[2], sys.stdin.buffer, sys.stdout.buffer)
+        else:
+            write(encrypt(sys.argv[2], text))
     elif 'decrypt'.startswith(sys.argv[1]):
-        write(decrypt(sys.argv[2], text))
+        if text is None:
+            decrypt_stream(sys.argv[2], sys.stdin.buffer, sys.stdout.buffer)
+        else:
+            write(decrypt(sys.argv[2], text))
     else:
         print('Expected command "encrypt" or "decrypt" in first argument.')
 
-    # encrypt('my secret key', b'0' * 1000000) # 1 MB encrypted in 20 seconds.
+    # encrypt('my secret key', b'0' * 1000000) # 1 MB encrypted in 2 seconds.
@@ -1,7 +1,17 @@
 import aes
+import array
 import collections
+import functools
 import itertools
-from utils import hex, compare, dump_diff
+import math
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, as_completed
+from utils import hex, compare, dump_diff, ranked_combinations
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # FAULT_PATTERNS[idx] is the fault pattern that appears when a byte of the
 # state column idx is faulted.
@@ -43,88 +53,1056 @@ def compute_propagation():
 FAULT_PROPAGATION = compute_propagation()
 
 
+# A faulted output, with the non faulted output of its plaintext when it
+# differs from the one of the recovery.
 class Fault:
-    def __init__(self, output, column):
+    __slots__ = ("output", "column", "ref")
+
+    def __init__(self, output, column, ref=None):
         self.output = output
         self.column = column
+        self.ref = ref
 
 
 
+# Returns the column of the fault pattern of diff, or None if diff is not one
+# of FAULT_PATTERNS.
 def recognize_fault_pattern(diff):
-    if len(diff) != 4:
+    if len(diff) != 4 or diff not in FAULT_PATTERNS:
         return None
 
-    assert diff in FAULT_PATTERNS
-
     return FAULT_PATTERNS.index(diff)
 
 
+# Faults may hit up to MAX_FAULTED_BYTES bytes of a column. Faults of 3 bytes
+# allow ~2^26 key candidates each, and faults of 4 bytes allow any key.
+MAX_FAULTED_BYTES = 2
+
+
+# Returns the non null differences of a column after MixColumns, for faults of
+# 1 to max_faulted_bytes bytes of the column, as a list of 4-tuples. The
+# single byte ones come first, in the order of FAULT_PROPAGATION.
+@functools.lru_cache(maxsize=None)
+def fault_differences(max_faulted_bytes=1):
+    assert 1 <= max_faulted_bytes <= MAX_FAULTED_BYTES
+
+    differences = [tuple(D) for D in FAULT_PROPAGATION if any(D)]
+    if max_faulted_bytes == 2:
+        # MixColumns is linear, the difference of a 2 bytes fault is the XOR
+        # of the differences of each byte.
+        for row_a, row_b in itertools.combinations(range(4), 2):
+            for Da in FAULT_PROPAGATION[row_a * 256 + 1 : row_a * 256 + 256]:
+                for Db in FAULT_PROPAGATION[row_b * 256 + 1 : row_b * 256 + 256]:
+                    differences.append((Da[0] ^ Db[0], Da[1] ^ Db[1], Da[2] ^ Db[2], Da[3] ^ Db[3]))
+
+    return differences
+
+
+# With x = ref_b ^ k, the partial decryption difference of compute_key_candidates
+# is inv_s_box[x] ^ inv_s_box[x ^ delta], with delta = ref_b ^ out_b. The
+# values of x giving a difference d only depend on (delta, d), so they are
+# precomputed once for all 256 * 256 pairs.
+# INV_SBOX_DIFFERENCES holds the 65536 values of x, grouped by (delta, d). The
+# values for (delta, d) start at INV_SBOX_DIFFERENCE_OFFSETS[delta * 256 + d],
+# and end where the next group starts.
+def compute_inv_sbox_differences():
+    groups = [[] for _ in range(256 * 256)]
+
+    for delta in range(256):
+        for x in range(256):
+            d = aes.inv_s_box[x] ^ aes.inv_s_box[x ^ delta]
+            groups[delta * 256 + d].append(x)
+
+    offsets = array.array("I", [0])
+    for group in groups:
+        offsets.append(offsets[-1] + len(group))
+
+    return bytes(itertools.chain.from_iterable(groups)), offsets
+
+
+INV_SBOX_DIFFERENCES, INV_SBOX_DIFFERENCE_OFFSETS = compute_inv_sbox_differences()
+
+
+# MixColumns multiplies the fault value by a constant that only depends on the
+# faulted row and on the byte, so each byte of the column restricts the fault
+# value on its own: for a reference/faulted difference delta, byte i only has
+# key candidates for some differences d, and each d comes from exactly one
+# fault value.
+# FEASIBLE_FAULTS[row][i][delta] is the 256-bit mask of the fault values on
+# row `row` for which byte i has key candidates given delta.
+def compute_feasible_faults():
+    masks_by_factor = {}
+    ret = []
+
+    for row in range(4):
+        ret.append([])
+        for i in range(4):
+            # A fault of value 1 makes a difference equal to the factor.
+            factor = FAULT_PROPAGATION[row * 256 + 1][i]
+            if factor not in masks_by_factor:
+                masks = []
+                for delta in range(256):
+                    mask = 0
+                    for fault in range(256):
+                        idx = delta * 256 + FAULT_PROPAGATION[row * 256 + fault][i]
+                        if INV_SBOX_DIFFERENCE_OFFSETS[idx] != INV_SBOX_DIFFERENCE_OFFSETS[idx + 1]:
+                            mask |= 1 << fault
+                    masks.append(mask)
+                masks_by_factor[factor] = masks
+
+            ret[-1].append(masks_by_factor[factor])
+
+    return ret
+
+
+FEASIBLE_FAULTS = compute_feasible_faults()
+
+
 # Return all values of k such that the difference of values after partial
 # decryption of the reference byte and of the faulted byte equals d
 def compute_key_candidates(ref_b, out_b, d):
-    cands = []
+    idx = (ref_b ^ out_b) * 256 + d
+    start = INV_SBOX_DIFFERENCE_OFFSETS[idx]
+    end = INV_SBOX_DIFFERENCE_OFFSETS[idx + 1]
+
+    return sorted(x ^ ref_b for x in INV_SBOX_DIFFERENCES[start:end])
+
+
+# 4-tuples of key bytes are handled as 32-bit integers, the first byte being
+# the most significant one.
+def pack_key(k):
+    return (k[0] << 24) | (k[1] << 16) | (k[2] << 8) | k[3]
+
+
+def unpack_key(k):
+    return tuple(k.to_bytes(4, "big"))
+
+
+# A single byte fault allowing more key candidates than this carries almost no
+# information and is skipped instead of being expanded. The limit grows with
+# the number of fault differences for multi-byte faults.
+MAX_FAULT_CANDIDATES = 1 << 16
+
+
+def max_fault_candidates(max_faulted_bytes):
+    return MAX_FAULT_CANDIDATES * len(fault_differences(max_faulted_bytes)) // len(fault_differences(1))
+
+
+def report_excessive_fault(fault, n_candidates):
+    print(f"Skipping {hex(fault.output)}: {n_candidates} key candidates")
+
+
+# Return the packed key candidates of the column hit by the fault, with one
+# entry for each fault difference D allowing it. `rows` are the possibly
+# faulted rows of single byte faults.
+def fault_key_candidates(ref, fault, rows=range(4), max_faulted_bytes=1):
+    key_indices = list(FAULT_DESTINATION[fault.column])
+    ref_bytes = [ref[key_index] for key_index in key_indices]
+    out_bytes = [fault.output[key_index] for key_index in key_indices]
+    deltas = [r ^ o for r, o in zip(ref_bytes, out_bytes)]
+    all_candidates = []
+    n_candidates = 0
+
+    if max_faulted_bytes > 1:
+        # Too many differences to solve for, check each one against the
+        # inverse S-box difference table.
+        offsets = INV_SBOX_DIFFERENCE_OFFSETS
+        groups = [delta * 256 for delta in deltas]
+        for D in fault_differences(max_faulted_bytes):
+            g0, g1, g2, g3 = groups[0] + D[0], groups[1] + D[1], groups[2] + D[2], groups[3] + D[3]
+            n = (
+                (offsets[g0 + 1] - offsets[g0])
+                * (offsets[g1 + 1] - offsets[g1])
+                * (offsets[g2 + 1] - offsets[g2])
+                * (offsets[g3 + 1] - offsets[g3])
+            )
+            if n:
+                all_candidates.append(
+                    [compute_key_candidates(ref_bytes[i], out_bytes[i], D[i]) for i in range(4)]
+                )
+                n_candidates += n
+
+    # We don't know what row was faulted, and we don't know what value
+    # was faulted, but the fault values for which all 4 bytes have key
+    # candidates can be solved for directly, without going over all of
+    # FAULT_PROPAGATION.
+    for row in rows if max_faulted_bytes == 1 else []:
+        feasible = FEASIBLE_FAULTS[row]
+        faults_mask = (
+            feasible[0][deltas[0]]
+            & feasible[1][deltas[1]]
+            & feasible[2][deltas[2]]
+            & feasible[3][deltas[3]]
+        )
+
+        while faults_mask:
+            fault_value = (faults_mask & -faults_mask).bit_length() - 1
+            faults_mask &= faults_mask - 1
+            D = FAULT_PROPAGATION[row * 256 + fault_value]
+
+            # D may be the fault that was introduced, there are key
+            # candidates for all 4 bytes. There may be multiple
+            # candidates for each byte, so go over all 4-tuples of
+            # candidates and register them all.
+            candidates = [
+                compute_key_candidates(ref_bytes[i], out_bytes[i], D[i])
+                for i in range(4)
+            ]
+            all_candidates.append(candidates)
+            n_candidates += len(candidates[0]) * len(candidates[1]) * len(candidates[2]) * len(candidates[3])
+
+    if n_candidates > max_fault_candidates(max_faulted_bytes):
+        report_excessive_fault(fault, n_candidates)
+        return []
+
+    return [
+        pack_key(k)
+        for candidates in all_candidates
+        for k in itertools.product(*candidates)
+    ]
+
+
+if np is not None:
+    # FAULT_PROPAGATION without the null faults, as a (1020, 4) array
+    NP_FAULT_PROPAGATION = np.array([D for D in FAULT_PROPAGATION if any(D)], dtype=np.uint8)
+
+
+# fault_differences as an (n, 4) uint8 array
+@functools.lru_cache(maxsize=None)
+def np_fault_differences(max_faulted_bytes=1):
+    if max_faulted_bytes == 1:
+        return NP_FAULT_PROPAGATION
+
+    single = NP_FAULT_PROPAGATION.reshape(4, 255, 4)
+    pairs = [
+        (single[row_a][:, None] ^ single[row_b][None, :]).reshape(-1, 4)
+        for row_a, row_b in itertools.combinations(range(4), 2)
+    ]
+    return np.concatenate([NP_FAULT_PROPAGATION] + pairs)
+
+
+if np is not None:
+    NP_INV_SBOX_DIFFERENCES = np.frombuffer(INV_SBOX_DIFFERENCES, dtype=np.uint8)
+    NP_INV_SBOX_DIFFERENCE_OFFSETS = np.array(INV_SBOX_DIFFERENCE_OFFSETS, dtype=np.int64)
+
+# Number of single byte faults analyzed at once by np_fault_key_candidates,
+# there are less of them in a batch for multi-byte faults.
+NP_FAULT_BATCH_SIZE = 1024
+
+
+def np_fault_batch_size(max_faulted_bytes):
+    return max(1, NP_FAULT_BATCH_SIZE * len(NP_FAULT_PROPAGATION) // len(np_fault_differences(max_faulted_bytes)))
+
+
+# Vectorized fault_key_candidates, for a list of faults hitting the same
+# column. Returns the packed key candidates of all faults as a uint32 array,
+# and the index in `faults` of the fault each candidate comes from.
+def np_fault_key_candidates(ref, faults, max_faulted_bytes=1):
+    key_indices = FAULT_DESTINATION[faults[0].column]
+    ref_bytes = np.array([ref[i] for i in key_indices], dtype=np.uint8)
+    out_bytes = np.array([[fault.output[i] for i in key_indices] for fault in faults], dtype=np.uint8)
+    deltas = (ref_bytes ^ out_bytes).astype(np.int64)
+
+    # For every fault f, every D of FAULT_PROPAGATION and every byte i, the
+    # key candidates of compute_key_candidates are a slice of the inverse
+    # S-box difference table: groups[f, D, i] is the index of that slice.
+    groups = deltas[:, None, :] * 256 + np_fault_differences(max_faulted_bytes)
+    starts = NP_INV_SBOX_DIFFERENCE_OFFSETS[groups]
+    counts = NP_INV_SBOX_DIFFERENCE_OFFSETS[groups + 1] - starts
+
+    # D is possible if there are key candidates for all 4 bytes.
+    fault_idx, D_idx = np.nonzero((counts > 0).all(axis=2))
+    starts = starts[fault_idx, D_idx]
+    counts = counts[fault_idx, D_idx]
+
+    # Drop the faults that would expand to too many candidates.
+    n_candidates = np.bincount(fault_idx, weights=counts.prod(axis=1), minlength=len(faults))
+    excessive = n_candidates > max_fault_candidates(max_faulted_bytes)
+    if excessive.any():
+        for f in np.nonzero(excessive)[0]:
+            report_excessive_fault(faults[f], int(n_candidates[f]))
+        kept = ~excessive[fault_idx]
+        fault_idx = fault_idx[kept]
+        starts = starts[kept]
+        counts = counts[kept]
+
+    # A non-zero difference never has more than 4 candidates, gather them
+    # all in a (possible D, byte, 4) array with a validity mask.
+    j = np.arange(4)
+    valid = j < counts[:, :, None]
+    idx = np.where(valid, starts[:, :, None] + j, 0)
+    c = (NP_INV_SBOX_DIFFERENCES[idx] ^ ref_bytes[:, None]).astype(np.uint32)
+    v = valid
+
+    # Expand all the 4-tuples of candidates and keep the valid ones.
+    keys = (
+        (c[:, 0, :, None, None, None] << 24)
+        | (c[:, 1, None, :, None, None] << 16)
+        | (c[:, 2, None, None, :, None] << 8)
+        | c[:, 3, None, None, None, :]
+    )
+    keep = v[:, 0, :, None, None, None] & v[:, 1, None, :, None, None] & v[:, 2, None, None, :, None] & v[:, 3, None, None, None, :]
+    owners = np.broadcast_to(fault_idx[:, None, None, None, None], keys.shape)
+
+    return keys[keep], owners[keep]
+
+
+# Scoring modes of AESRecovery:
+#   votes:      every key candidate of a fault gets one vote, for every D
+#               allowing it
+#   likelihood: every distinct key candidate of a fault gets the information
+#               brought by the fault, log2(2^32 / n) bits for a fault allowing
+#               n candidates, the score of a key being its log-likelihood
+#               ratio against a random key. Faults allowing few candidates
+#               weigh more than the ones allowing many.
+SCORING_MODES = ["votes", "likelihood"]
+
+
+def fault_information(n_candidates):
+    return 32 - math.log2(n_candidates)
+
+
+# Returns the packed key candidates of the faults in `faults` and their weight
+# for the given scoring mode.
+def scored_key_candidates(ref, faults, scoring, max_faulted_bytes=1):
+    if np is None:
+        keys = []
+        weights = []
+        for fault in faults:
+            candidates = fault_key_candidates(ref, fault, max_faulted_bytes=max_faulted_bytes)
+            if scoring == "likelihood" and candidates:
+                candidates = list(set(candidates))
+                weights.extend([fault_information(len(candidates))] * len(candidates))
+            keys.extend(candidates)
+
+        return keys, (weights if scoring == "likelihood" else 1)
+
+    keys, owners = np_fault_key_candidates(ref, faults, max_faulted_bytes)
+    if scoring == "votes":
+        return keys, 1
+
+    # Count each key once per fault
+    pairs = np.unique((owners.astype(np.uint64) << 32) | keys)
+    keys = (pairs & 0xFFFFFFFF).astype(np.uint32)
+    owners = (pairs >> 32).astype(np.int64)
+    n_candidates = np.bincount(owners, minlength=len(faults))
+
+    return keys, 32 - np.log2(n_candidates[owners])
+
+
+# Number of pending votes after which KeyVotes merges them
+KEY_VOTES_MERGE_SIZE = 1 << 20
+
+
+class KeyVotes:
+    """
+    Vote counts for the packed keys of one column, out of a 2^32 key space.
+    Votes are ints, or floats when `weighted`.
+
+    With NumPy, the counted keys are a sorted uint32 array with a parallel
+    array of counts, new votes being buffered and merged in batches.
+    Otherwise, the counts are a dict.
+    """
+
+    def __init__(self, weighted=False):
+        if np is not None:
+            self._dtype = np.float64 if weighted else np.int64
+            self._keys = np.empty(0, dtype=np.uint32)
+            self._counts = np.empty(0, dtype=self._dtype)
+            self._pending = []
+            self._n_pending = 0
+        else:
+            self._counts = collections.Counter()
+
+    def add(self, keys, weights=1):
+        """
+        Adds a vote for each packed key of `keys` (a list or a uint32 array),
+        weighing `weights` (a number, or a sequence with one weight per key).
+        """
+        if np is None:
+            if weights == 1:
+                self._counts.update(keys)
+            else:
+                for key, weight in zip(keys, weights):
+                    self._counts[key] += weight
+            return
+
+        keys = np.asarray(keys, dtype=np.uint32)
+        self._pending.append((keys, np.broadcast_to(np.asarray(weights, dtype=self._dtype), keys.shape)))
+        self._n_pending += len(keys)
+        if self._n_pending >= KEY_VOTES_MERGE_SIZE:
+            self._merge()
+
+    def _merge(self):
+        if not self._pending:
+            return
+
+        new_keys = np.concatenate([keys for keys, _ in self._pending])
+        new_weights = np.concatenate([weights for _, weights in self._pending])
+        self._pending = []
+        self._n_pending = 0
+
+        keys, inverse = np.unique(np.concatenate([self._keys, new_keys]), return_inverse=True)
+        weights = np.concatenate([self._counts, new_weights])
+        self._keys = keys.astype(np.uint32)
+        self._counts = np.bincount(inverse.ravel(), weights=weights, minlength=len(keys)).astype(self._dtype)
+
+    def __len__(self):
+        if np is None:
+            return len(self._counts)
+
+        self._merge()
+        return len(self._keys)
+
+    def most_common(self, n=None):
+        """
+        Returns the n keys with the most votes as (packed key, count) pairs,
+        most voted first.
+        """
+        if np is None:
+            return self._counts.most_common(n)
+
+        self._merge()
+        order = np.argsort(-self._counts, kind="stable")[:n]
+        return list(zip(self._keys[order].tolist(), self._counts[order].tolist()))
+
+
+# Number of candidates per column used to rank round 10 keys
+RANKED_CANDIDATES = 1 << 12
+
+# Column status of AESRecovery
+COLUMN_EMPTY = "empty"
+COLUMN_AMBIGUOUS = "ambiguous"
+COLUMN_UNIQUE = "unique"
+COLUMN_KNOWN = "known"
+
+
+class AESRecovery:
+    """
+    Incremental recovery of the round 10 key from faulted outputs, for
+    acquisition loops that stop as soon as the key is known.
+
+    Faulted outputs are compared to `ref`, the non faulted output of their
+    plaintext. Faults of other plaintexts encrypted with the same key can be
+    added with their own reference, their votes going to the same columns.
+
+    Faults may hit up to `max_faulted_bytes` bytes of a column (at most
+    MAX_FAULTED_BYTES). Outputs that don't match a fault pattern are counted
+    in n_unrecognized.
+
+    Key candidates are scored with one of the SCORING_MODES. A column is
+    unique once its best key leads the runner-up by at least `margin` (votes
+    or bits). The faults hitting a unique column are skipped without
+    computing their key candidates.
+
+    Columns already known, e.g. from an earlier session, can be pinned with
+    `known_columns`, a dict of column index to its 4 key bytes (in the
+    FAULT_DESTINATION order). Their faults are skipped as well, so the cost
+    of the recovery only depends on the unknown columns.
+    """
+
+    def __init__(self, ref=None, margin=1, scoring="votes", max_faulted_bytes=1, known_columns=None):
+        assert margin > 0
+        assert scoring in SCORING_MODES
+        assert 1 <= max_faulted_bytes <= MAX_FAULTED_BYTES
+
+        self.known = {}
+        for column, key in (known_columns or {}).items():
+            assert 0 <= column < 4 and len(key) == 4
+            self.known[column] = tuple(key)
+
+        self.ref = ref
+        self.margin = margin
+        self.scoring = scoring
+        self.max_faulted_bytes = max_faulted_bytes
+        self.votes = [KeyVotes(weighted=scoring != "votes") for _ in range(4)]
+        self.n_faults = [0] * 4
+        self.n_skipped = 0
+        self.n_unrecognized = 0
+
+    def add_fault(self, output, ref=None):
+        """
+        Adds a faulted output of the plaintext whose non faulted output is
+        `ref` (default: the recovery's), and returns the index of the column
+        it hits, or None if it doesn't match a fault pattern.
+        """
+        if ref is None:
+            ref = self.ref
+        diff = compare(ref, output)
+        column = recognize_fault_pattern(diff)
+        if column is not None:
+            self.add_faults([Fault(output, column, ref)])
+        elif diff:
+            self.n_unrecognized += 1
+
+        return column
+
+    def add_pairs(self, pairs):
+        """
+        Adds a list of (ref, faulted output) pairs, and returns the number of
+        them matching a fault pattern.
+        """
+        faults = []
+        for ref, output in pairs:
+            diff = compare(ref, output)
+            column = recognize_fault_pattern(diff)
+            if column is not None:
+                faults.append(Fault(output, column, ref))
+            elif diff:
+                self.n_unrecognized += 1
+
+        self.add_faults(faults)
+        return len(faults)
+
+    def add_faults(self, faults):
+        """
+        Adds a list of Fault objects, in vectorized batches with NumPy. The
+        faults are grouped by reference, so that each one is only prepared
+        once per batch. The faults of the columns that are known, or unique
+        when called, are skipped.
+        """
+        for column in range(4):
+            column_faults = [fault for fault in faults if fault.column == column]
+            if not column_faults:
+                continue
+
+            if self.column_status(column) in (COLUMN_UNIQUE, COLUMN_KNOWN):
+                self.n_skipped += len(column_faults)
+                continue
+
+            by_ref = collections.defaultdict(list)
+            for fault in column_faults:
+                by_ref[bytes(self.ref if fault.ref is None else fault.ref)].append(fault)
+
+            self.n_faults[column] += len(column_faults)
+            batch_size = np_fault_batch_size(self.max_faulted_bytes) if np is not None else 1
+            for ref, ref_faults in by_ref.items():
+                for start in range(0, len(ref_faults), batch_size):
+                    batch = ref_faults[start : start + batch_size]
+                    candidates = scored_key_candidates(ref, batch, self.scoring, self.max_faulted_bytes)
+                    self.votes[column].add(*candidates)
 
-    for k in range(256):
-        if aes.inv_s_box[ref_b ^ k] ^ aes.inv_s_box[out_b ^ k] == d:
-            cands.append(k)
+    def column_margin(self, column):
+        """
+        Returns the score difference between the best key of the column and
+        the runner-up, or None if the column has no candidate.
+        """
+        top = self.votes[column].most_common(2)
+        if not top:
+            return None
 
-    return cands
+        runner_up = top[1][1] if len(top) > 1 else 0
+        return top[0][1] - runner_up
 
+    def margins(self):
+        return [self.column_margin(column) for column in range(4)]
 
-def recover_key(ref, faults):
-    # There are 4 subkeys
-    KEY_SETS = [collections.Counter() for _ in range(4)]
+    def column_status(self, column):
+        if column in self.known:
+            return COLUMN_KNOWN
+
+        margin = self.column_margin(column)
+        if margin is None:
+            return COLUMN_EMPTY
+        if margin >= self.margin:
+            return COLUMN_UNIQUE
+
+        return COLUMN_AMBIGUOUS
+
+    def status(self):
+        return [self.column_status(column) for column in range(4)]
+
+    @property
+    def converged(self):
+        return all(status in (COLUMN_UNIQUE, COLUMN_KNOWN) for status in self.status())
+
+    def key(self):
+        """
+        Returns the round 10 key made of the most voted key of each column.
+        Every column needs to be known or to have at least one fault.
+        """
+        key = [0] * 16
+
+        for pattern_idx in range(len(FAULT_DESTINATION)):
+            if pattern_idx in self.known:
+                most_common = self.known[pattern_idx]
+            else:
+                most_common = unpack_key(self.votes[pattern_idx].most_common(1)[0][0])
+            for i, key_index in enumerate(FAULT_DESTINATION[pattern_idx]):
+                key[key_index] = most_common[i]
+
+        return key
+
+    def column_candidates(self, column, n=None):
+        """
+        Returns the n best keys of the column as (4-tuple, score) pairs, best
+        first. A known column only has its key, with a score of 0.
+        """
+        if column in self.known:
+            return [(self.known[column], 0)]
+
+        return [(unpack_key(k), score) for k, score in self.votes[column].most_common(n)]
+
+    def candidates(self, n=RANKED_CANDIDATES):
+        return [self.column_candidates(column, n) for column in range(4)]
+
+
+# Recovers the round 10 key from a list of Fault objects. The columns of
+# `known_columns` (see AESRecovery) are pinned, and their faults dropped.
+def recover_key(ref, faults, scoring="votes", max_faulted_bytes=1, known_columns=None):
+    known_columns = known_columns or {}
+    n_pinned = sum(fault.column in known_columns for fault in faults)
+    faults = [fault for fault in faults if fault.column not in known_columns]
+    if n_pinned:
+        print(f"Dropped {n_pinned} faults of known columns")
 
     for fault in faults:
         print(f"Analyzing {hex(fault.output)}")
-        key_indices = list(FAULT_DESTINATION[fault.column])
-
-        # We don't know what row was faulted, and we don't know what value
-        # was faulted, so we have to go over everything.
-        for D in FAULT_PROPAGATION:
-            candidates = []
-
-            # Check if D may be the fault that was introduced.
-            # There must be key candidates for all 4 bytes.
-            for i in range(4):
-                key_index = key_indices[i]
-                c = compute_key_candidates(
-                    ref[key_index], fault.output[key_index], D[i]
-                )
-                if len(c) == 0:
-                    break
 
-                candidates.append(c)
+    recovery = AESRecovery(ref, scoring=scoring, max_faulted_bytes=max_faulted_bytes, known_columns=known_columns)
+    recovery.add_faults(faults)
 
-            # If we have candidates for all 4 bytes, register them.
-            # There may be multiple candidates for each byte, so go over
-            # all 4-tuples of candidates and register them all.
-            if len(candidates) == 4:
-                for k in itertools.product(*candidates):
-                    KEY_SETS[fault.column][k] += 1
+    for column, margin in enumerate(recovery.margins()):
+        if column in known_columns:
+            print(f"Column {column}: known")
+        elif margin is None:
+            print(f"Column {column}: no fault")
+        else:
+            print(f"Column {column}: {recovery.column_status(column)}, margin {margin:g}")
 
     # We have analysed all the faults, it is now highly likely that the most
     # common 4-tuple of each fault pattern is the correct key.
-    key = [0] * 16
+    return recovery.key()
 
-    for pattern_idx in range(len(FAULT_DESTINATION)):
-        most_common = KEY_SETS[pattern_idx].most_common(1)[0][0]
-        for i, key_index in enumerate(FAULT_DESTINATION[pattern_idx]):
-            key[key_index] = most_common[i]
 
-    return key
+def recover_aes_key(ref, faulted_outputs, scoring="votes", max_faulted_bytes=1, known_columns=None):
+    return recover_aes_key_pairs(
+        [(ref, fault) for fault in faulted_outputs], scoring, max_faulted_bytes, known_columns
+    )
 
 
-def recover_aes_key(ref, faulted_outputs):
+# Recovers the round 10 key from (ref, faulted output) pairs, where ref is the
+# non faulted output of the plaintext of the faulted output. All plaintexts
+# must have been encrypted with the same key.
+def recover_aes_key_pairs(pairs, scoring="votes", max_faulted_bytes=1, known_columns=None):
     faults = []
+    n_unrecognized = 0
 
-    for fault in faulted_outputs:
+    for ref, fault in pairs:
         diffs = compare(ref, fault)
         column_idx = recognize_fault_pattern(diffs)
         if column_idx is None:
+            if diffs:
+                n_unrecognized += 1
             continue
 
         dump_diff(ref, fault, diffs)
-        faults.append(Fault(fault, column_idx))
+        faults.append(Fault(fault, column_idx, ref))
+
+    if n_unrecognized:
+        print(f"Skipped {n_unrecognized} faulted outputs with an unknown pattern")
+
+    return recover_key(None, faults, scoring, max_faulted_bytes, known_columns)
+
+
+def combination_key(columns, ranks):
+    key = [0] * 16
+    for column, rank in enumerate(ranks):
+        for i, key_index in enumerate(FAULT_DESTINATION[column]):
+            key[key_index] = columns[column][rank][0][i]
+
+    return key
+
+
+# Yields (round 10 key, score) pairs in decreasing order of score, see
+# ranked_combinations.
+def ranked_keys(columns):
+    for ranks, score in ranked_combinations(columns):
+        yield combination_key(columns, ranks), score
+
+
+# Number of round 10 keys verified at once by search_master_key
+MASTER_KEY_BATCH_SIZE = 4096
+
+
+# Returns the index in master_keys of the key encrypting plaintext to ref, or
+# None.
+def find_master_key(master_keys, plaintext, ref):
+    outputs = aes.encrypt_block_many_keys(plaintext, aes.expand_keys(master_keys))
+    if np is None:
+        return next((i for i, output in enumerate(outputs) if output == bytes(ref)), None)
+
+    matches = np.nonzero((outputs == np.frombuffer(bytes(ref), dtype=np.uint8)).all(axis=1))[0]
+    return int(matches[0]) if len(matches) else None
+
+
+# Tries the max_tries best round 10 keys made of the candidates of `columns`
+# (see ranked_combinations), and returns the AES-128 master key encrypting
+# plaintext to ref, or None. Keys are inverted and verified in batches of
+# MASTER_KEY_BATCH_SIZE.
+def search_master_key(columns, plaintext, ref, max_tries=1 << 20):
+    combinations = itertools.islice(ranked_combinations(columns), max_tries)
+    if np is not None:
+        candidates = [np.array([k for k, _ in column], dtype=np.uint8).reshape(-1, 4) for column in columns]
+    tries = 0
+
+    while True:
+        ranks = [r for r, _ in itertools.islice(combinations, MASTER_KEY_BATCH_SIZE)]
+        if not ranks:
+            return None
+
+        if np is not None:
+            ranks = np.array(ranks)
+            batch = np.empty((len(ranks), 16), dtype=np.uint8)
+            for column in range(4):
+                batch[:, FAULT_DESTINATION[column]] = candidates[column][ranks[:, column]]
+        else:
+            batch = [bytes(combination_key(columns, r)) for r in ranks]
+
+        master_keys = aes.reverse_key_schedules(batch)
+        match = find_master_key(master_keys, plaintext, ref)
+        if match is not None:
+            return bytes(master_keys[match])
+
+        tries += len(batch)
+        print(f"Tried {tries} round 10 keys")
+
+
+# Recovers the AES-128 master key from (ref, faulted output) pairs and a
+# plaintext encrypting to ref, trying the round 10 keys in decreasing score.
+# The columns of `known_columns` (see AESRecovery) only have their key.
+def recover_aes_master_key_pairs(
+    pairs, plaintext, ref, scoring="likelihood", max_faulted_bytes=1, max_tries=1 << 20, known_columns=None
+):
+    recovery = AESRecovery(scoring=scoring, max_faulted_bytes=max_faulted_bytes, known_columns=known_columns)
+    recovery.add_pairs(pairs)
+    if recovery.n_unrecognized:
+        print(f"Skipped {recovery.n_unrecognized} faulted outputs with an unknown pattern")
+
+    columns = recovery.candidates()
+    for column, candidates in enumerate(columns):
+        if column in recovery.known:
+            print(f"Column {column}: known")
+        else:
+            print(f"Column {column}: {recovery.column_status(column)}, {len(recovery.votes[column])} candidates")
+        if not candidates:
+            return None
+
+    return search_master_key(columns, plaintext, ref, max_tries)
+
+
+# Round 8 faults: a byte faulted before the round 8 MixColumns spreads to the
+# whole column c, then to one byte of each column before the round 9
+# MixColumns, and to the 16 bytes of the output.
+# For the round 10 key, column j (as in FAULT_DESTINATION) therefore sees a
+# round 9 fault in row (c - j) % 4, leaving ~2^8 candidates for each column
+# and ~2^32 combinations. These are filtered by decrypting back to the output
+# of round 8, whose difference must be a FAULT_PROPAGATION entry in column c,
+# which leaves ~2^12 keys for one fault.
+
+# Non null differences of a column after a single byte fault and MixColumns
+ROUND8_DIFFERENCES = frozenset(tuple(D) for D in FAULT_PROPAGATION if any(D))
+
+
+def recognize_round8_fault(diff):
+    return len(diff) == 16
+
+
+def gf_mul(a, b):
+    ret = 0
+    while b:
+        if b & 1:
+            ret ^= a
+        a = aes.xtime(a)
+        b >>= 1
+
+    return ret
+
+
+# InvMixColumns coefficient of the byte in row b for the output row i
+def inv_mix_coefficient(i, b):
+    return (14, 11, 13, 9)[(b - i) % 4]
+
+
+# Returns the difference between ref and output at the output of round 8,
+# for the round 10 key `key` (16 bytes).
+def round8_difference(ref, output, key):
+    key_matrix = aes.bytes2matrix(bytes(key))
+    previous_matrix = aes.bytes2matrix(aes.previous_round_key(bytes(key), 10))
+
+    def decrypt(block):
+        state = aes.bytes2matrix(bytes(block))
+        aes.add_round_key(state, key_matrix)
+        aes.inv_shift_rows(state)
+        aes.inv_sub_bytes(state)
+        aes.add_round_key(state, previous_matrix)
+        aes.inv_mix_columns(state)
+        aes.inv_shift_rows(state)
+        aes.inv_sub_bytes(state)
+        return aes.matrix2bytes(state)
+
+    return aes.xor_bytes(decrypt(ref), decrypt(output))
+
+
+# Returns whether the round 10 key `key` explains the round 8 fault of output.
+def round8_key_matches(ref, output, key):
+    diff = round8_difference(ref, output, key)
+    columns = [tuple(diff[4 * c : 4 * c + 4]) for c in range(4)]
+    faulted = [column for column in columns if any(column)]
+
+    return len(faulted) == 1 and faulted[0] in ROUND8_DIFFERENCES
+
+
+if np is not None:
+    NP_GF_MUL = np.array([[gf_mul(a, b) for b in range(256)] for a in range(256)], dtype=np.uint8)
+    # The first two bytes of a ROUND8_DIFFERENCES entry are enough to find
+    # it. NP_ROUND8_PREFIXES tells whether there's an entry starting with
+    # (byte 0 << 8) | byte 1, NP_ROUND8_SUFFIXES gives its last two bytes.
+    NP_ROUND8_PREFIXES = np.zeros(1 << 16, dtype=bool)
+    NP_ROUND8_SUFFIXES = np.zeros(1 << 16, dtype=np.uint16)
+    for D in ROUND8_DIFFERENCES:
+        NP_ROUND8_PREFIXES[(D[0] << 8) | D[1]] = True
+        NP_ROUND8_SUFFIXES[(D[0] << 8) | D[1]] = (D[2] << 8) | D[3]
+
+
+# Evaluates a table of values over the candidates of `columns` with the
+# candidates of the columns in `fixed` (a dict) set, as an array that
+# broadcasts over the candidates of the two columns of `axes`.
+def _round8_grid(table, columns, fixed, axes):
+    table = table[tuple(fixed.get(c, slice(None)) for c in columns)]
+    remaining = [c for c in columns if c not in fixed]
+    kept = [c for c in axes if c in remaining]
+    table = np.transpose(table, [remaining.index(c) for c in kept])
+    sizes = dict(zip(kept, table.shape))
+
+    return table.reshape([sizes.get(c, 1) for c in axes])
+
+
+def _add_round8_term(terms, columns, values):
+    if columns in terms:
+        terms[columns] = terms[columns] ^ values
+    else:
+        terms[columns] = values
+
+
+# Prepares the search of the round 10 keys for a round 8 fault in the column
+# c, see _round8_search_chunk. The columns of `known_columns` (see
+# AESRecovery) only keep their key. Returns None if a column has no candidate.
+def _round8_tables(ref, output, c, known_columns=None):
+    known_columns = known_columns or {}
+    candidates = []
+    for j in range(4):
+        keys = fault_key_candidates(ref, Fault(output, j), rows=[(c - j) % 4])
+        if j in known_columns:
+            known = pack_key(known_columns[j])
+            keys = [known] if known in keys else []
+        if not keys:
+            return None
+        candidates.append(np.array([unpack_key(k) for k in keys], dtype=np.uint8))
+
+    # The round 10 key byte in column `col` and row `row` is the byte `row`
+    # of the candidates of the FAULT_DESTINATION column (col + row) % 4.
+    def key_byte(col, row):
+        return (col + row) % 4, candidates[(col + row) % 4][:, row]
+
+    # terms[j] are the XORed tables giving the round 9 MixColumns input of
+    # the byte of column j faulted by the round 8 fault, in row i = (c - j) % 4.
+    # It's InvMixColumns(S9 ^ K9) with S9 the state after the round 9
+    # AddRoundKey and K9 the round 9 key, so it splits into terms depending on
+    # at most two of the columns.
+    terms = []
+    deltas = []
+    for j in range(4):
+        i = (c - j) % 4
+        destination = FAULT_DESTINATION[j]
+        ref_s9 = aes._np_inv_s_box[np.array([ref[p] for p in destination], dtype=np.uint8) ^ candidates[j]]
+        out_s9 = aes._np_inv_s_box[np.array([output[p] for p in destination], dtype=np.uint8) ^ candidates[j]]
+        ref_mixed = np.zeros(len(candidates[j]), dtype=np.uint8)
+        out_mixed = np.zeros(len(candidates[j]), dtype=np.uint8)
+        for b in range(4):
+            ref_mixed ^= NP_GF_MUL[inv_mix_coefficient(i, b)][ref_s9[:, b]]
+            out_mixed ^= NP_GF_MUL[inv_mix_coefficient(i, b)][out_s9[:, b]]
+
+        column_terms = {(j,): ref_mixed}
+        deltas.append(ref_mixed ^ out_mixed)
+
+        # K9 column j is K10[j] ^ K10[j - 1], or for the first column
+        # K10[0] ^ SubWord(RotWord(K10[3] ^ K10[2])) ^ Rcon.
+        for b in range(4):
+            coefficient = NP_GF_MUL[inv_mix_coefficient(i, b)]
+            sources = [(j, b), (j - 1, b)] if j else [(0, b)]
+            for col, row in sources:
+                column, values = key_byte(col, row)
+                _add_round8_term(column_terms, (column,), coefficient[values])
+
+            if j == 0:
+                q = (b + 1) % 4
+                (column_a, values_a), (column_b, values_b) = key_byte(3, q), key_byte(2, q)
+                sub_word = aes._np_s_box[values_a[:, None] ^ values_b[None, :]]
+                _add_round8_term(column_terms, (column_a, column_b), coefficient[sub_word])
+                if b == 0:
+                    _add_round8_term(column_terms, (0,), coefficient[aes.r_con[10]])
+
+        terms.append(column_terms)
+
+    return candidates, terms, deltas
+
+
+# Searches the keys of the round 8 fault in column c, for the candidates in
+# [start, stop) of the column c, and returns the matching round 10 keys.
+# The two columns whose faulted bytes end up in rows 0 and 1 of the round 8
+# output are fixed in the outer loops, so that checking these two bytes over
+# the grid of the other two columns only takes a 16-bit table lookup.
+def _round8_search_chunk(c, tables, start, stop):
+    candidates, terms, deltas = tables
+    # by_row[r] is the column of the round 10 key whose fault gives the byte
+    # in row r of the round 8 output.
+    by_row = [(c - r) % 4 for r in range(4)]
+    p, q = by_row[0], by_row[1]
+    axes = sorted(by_row[2:])
+    n_u, n_v = (len(candidates[j]) for j in axes)
+
+    def split(j):
+        # Terms over the candidates of the grid only, and the other ones
+        grid = np.zeros((n_u, n_v), dtype=np.uint8)
+        outer = []
+        for columns, table in terms[j].items():
+            if p in columns or q in columns:
+                outer.append((columns, table))
+            else:
+                grid = grid ^ _round8_grid(table, columns, {}, axes)
+        return grid, outer
+
+    grids, outers = zip(*(split(j) for j in range(4)))
+    grid16 = (grids[p].astype(np.uint16) << 8) | grids[q]
+    inv_s_box16 = aes._np_inv_s_box.astype(np.uint16)
+    keys = []
+
+    prefixes_ok = NP_ROUND8_PREFIXES.reshape(256, 256)
+
+    for x_p in range(start, stop):
+        high = (inv_s_box16 ^ inv_s_box16[np.arange(256) ^ deltas[p][x_p]]) << 8
+        high_ok = prefixes_ok[high >> 8]
+        for x_q in range(len(candidates[q])):
+            fixed = {p: x_p, q: x_q}
+
+            def outer_terms(j):
+                # The outer terms add up to a vector over each grid axis
+                u = np.zeros((n_u, 1), dtype=np.uint8)
+                v = np.zeros((1, n_v), dtype=np.uint8)
+                for columns, table in outers[j]:
+                    value = _round8_grid(table, columns, fixed, axes)
+                    if value.shape[0] == 1:
+                        v = v ^ value
+                    else:
+                        u = u ^ value
+                return u, v
+
+            (u_p, v_p), (u_q, v_q) = outer_terms(p), outer_terms(q)
+            u = (u_p.astype(np.uint16) << 8) | u_q
+            v = (v_p.astype(np.uint16) << 8) | v_q
+            low = aes._np_inv_s_box ^ aes._np_inv_s_box[np.arange(256) ^ deltas[q][x_q]]
+            ok = np.take(high_ok, low, axis=1).ravel()
+
+            i_u, i_v = np.nonzero(ok[grid16 ^ u ^ v])
+            if not len(i_u):
+                continue
+
+            mixed = grid16[i_u, i_v] ^ u[i_u, 0] ^ v[0, i_v]
+            prefixes = high[mixed >> 8] | low[mixed & 0xFF]
+
+            x = {p: x_p, q: x_q, axes[0]: i_u, axes[1]: i_v}
+            suffixes = np.zeros(len(i_u), dtype=np.uint16)
+            for row in (2, 3):
+                j = by_row[row]
+                u_j, v_j = outer_terms(j)
+                mixed = grids[j][i_u, i_v] ^ u_j[i_u, 0] ^ v_j[0, i_v]
+                delta = deltas[j][x[j]]
+                diff = aes._np_inv_s_box[mixed] ^ aes._np_inv_s_box[mixed ^ delta]
+                suffixes |= diff.astype(np.uint16) << (8 * (3 - row))
+
+            for match in np.nonzero(NP_ROUND8_SUFFIXES[prefixes] == suffixes)[0]:
+                key = [0] * 16
+                for j in range(4):
+                    x_j = x[j] if j in (p, q) else x[j][match]
+                    for row, key_index in enumerate(FAULT_DESTINATION[j]):
+                        key[key_index] = int(candidates[j][x_j, row])
+                keys.append(bytes(key))
+
+    return keys
+
+
+def report_round8_progress(done, total, n_keys):
+    print(f"Round 8 search: {done}/{total} chunks, {n_keys} keys")
+
+
+# Returns the round 10 key candidates explaining a round 8 fault of output:
+# ~2^12 for a single fault. The search runs over `workers` processes (a number,
+# or a concurrent.futures.Executor, default: one per CPU), calling
+# progress(done, total, n_keys) after each chunk. Pinning `known_columns` (see
+# AESRecovery) shrinks the search to the other columns.
+def round8_key_candidates(ref, output, workers=None, progress=report_round8_progress, known_columns=None):
+    if np is None:
+        raise RuntimeError("The round 8 search needs NumPy")
+
+    jobs = []
+    for c in range(4):
+        tables = _round8_tables(ref, output, c, known_columns)
+        if tables is None:
+            continue
+
+        n_c = len(tables[0][c])
+        step = max(1, n_c // 16)
+        jobs += [(c, tables, start, min(n_c, start + step)) for start in range(0, n_c, step)]
+
+    keys = []
+    if workers == 1:
+        for i, job in enumerate(jobs):
+            keys += _round8_search_chunk(*job)
+            progress(i + 1, len(jobs), len(keys))
+        return keys
+
+    owned = not isinstance(workers, Executor)
+    executor = ProcessPoolExecutor(workers or os.cpu_count()) if owned else workers
+    try:
+        futures = [executor.submit(_round8_search_chunk, *job) for job in jobs]
+        for i, future in enumerate(as_completed(futures)):
+            keys += future.result()
+            progress(i + 1, len(jobs), len(keys))
+    finally:
+        if owned:
+            executor.shutdown()
+
+    return keys
+
+
+# Recovers the round 10 key from (ref, faulted output) pairs of round 8
+# faults. The first fault is searched, and the other ones filter its
+# candidates: one fault leaves ~2^12 keys, two are usually enough for a unique
+# key. Returns the list of the remaining keys.
+def recover_round8_key_pairs(pairs, workers=None, known_columns=None):
+    faults = []
+
+    for ref, fault in pairs:
+        diffs = compare(ref, fault)
+        if not recognize_round8_fault(diffs):
+            continue
+
+        dump_diff(ref, fault, diffs)
+        faults.append((ref, fault))
+
+    if not faults:
+        return []
+
+    print(f"Searching the keys of {hex(faults[0][1])}")
+    keys = round8_key_candidates(*faults[0], workers=workers, known_columns=known_columns)
+
+    for ref, fault in faults[1:]:
+        keys = [key for key in keys if round8_key_matches(ref, fault, key)]
+        print(f"Filtering with {hex(fault)}: {len(keys)} keys")
+
+    return [list(key) for key in keys]
+
 
-    return recover_key(ref, faults)
+def recover_round8_key(ref, faulted_outputs, workers=None, known_columns=None):
+    return recover_round8_key_pairs([(ref, fault) for fault in faulted_outputs], workers, known_columns)
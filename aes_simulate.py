@@ -0,0 +1,140 @@
+import aes
+import random
+from utils import hex
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Supported fault models, applied to the state right before the MixColumns
+# of the faulted round:
+#   set:    the faulted byte is replaced by `value`, or by a random value
+#   xor:    the faulted byte is xored with a random non-zero value
+#   bit:    a single random bit of the faulted byte is flipped
+#   column: every byte of the faulted byte's column is xored with a random
+#           value, at least one of them being non-zero
+FAULT_TYPES = ["set", "xor", "bit", "column"]
+
+# Number of faults simulated per batch by `simulate_to_file`
+SIMULATION_BATCH_SIZE = 1 << 16
+
+
+def _np_inject(state, position, fault_type, value, rng):
+    n = len(state)
+    lanes = np.arange(n)
+
+    if position is None:
+        positions = rng.integers(0, 16, n)
+    else:
+        positions = np.full(n, position)
+
+    if fault_type == "set":
+        if value is None:
+            state[lanes, positions] = rng.integers(0, 256, n, dtype=np.uint8)
+        else:
+            state[lanes, positions] = value
+    elif fault_type == "xor":
+        state[lanes, positions] ^= rng.integers(1, 256, n, dtype=np.uint8)
+    elif fault_type == "bit":
+        state[lanes, positions] ^= np.left_shift(1, rng.integers(0, 8, n)).astype(np.uint8)
+    else:
+        columns = (positions // 4)[:, None] * 4 + np.arange(4)
+        values = rng.integers(0, 256, (n, 4), dtype=np.uint8)
+        values[~values.any(axis=1), 0] = 1
+        state[lanes[:, None], columns] ^= values
+
+
+def _inject(state, position, fault_type, value, rng):
+    if position is None:
+        position = rng.randrange(16)
+    col, row = divmod(position, 4)
+
+    if fault_type == "set":
+        state[col][row] = rng.randrange(256) if value is None else value
+    elif fault_type == "xor":
+        state[col][row] ^= rng.randrange(1, 256)
+    elif fault_type == "bit":
+        state[col][row] ^= 1 << rng.randrange(8)
+    else:
+        values = [0]
+        while not any(values):
+            values = [rng.randrange(256) for _ in range(4)]
+        for i in range(4):
+            state[col][i] ^= values[i]
+
+
+def simulate_batches(
+    cipher,
+    plaintext,
+    count,
+    fault_round=9,
+    position=None,
+    fault_type="set",
+    value=None,
+    seed=None,
+    batch_size=SIMULATION_BATCH_SIZE,
+):
+    """
+    Generates `count` faulted encryptions of `plaintext`, in batches of at
+    most `batch_size`.
+
+    The fault hits the state of round `fault_round` right before its
+    MixColumns, at the state byte `position` (4 * column + row, or None for
+    a random byte per fault), with one of the FAULT_TYPES.
+    The fault-free part of the encryption is only computed once.
+
+    With NumPy, every batch is an (n, 16) uint8 array of outputs, computed
+    in one vectorized pass. Otherwise it's a list of 16-byte outputs.
+    """
+    assert fault_type in FAULT_TYPES
+    assert 1 <= fault_round <= cipher.n_rounds
+    assert position is None or 0 <= position < 16
+
+    if np is not None:
+        rng = np.random.default_rng(seed)
+        round_keys = cipher._np_round_keys()
+        block = np.frombuffer(bytes(plaintext), dtype=np.uint8).reshape(1, 16)
+        prefix = aes.np_encrypt_until(block, round_keys, fault_round)
+
+        for start in range(0, count, batch_size):
+            state = np.repeat(prefix, min(batch_size, count - start), axis=0)
+            _np_inject(state, position, fault_type, value, rng)
+            yield aes.np_encrypt_from(state, round_keys, fault_round)
+        return
+
+    rng = random.Random(seed)
+    checkpoint = cipher.checkpoint(plaintext, fault_round)
+    inject = lambda state: _inject(state, position, fault_type, value, rng)
+
+    for start in range(0, count, batch_size):
+        yield [cipher.resume(checkpoint, inject) for _ in range(min(batch_size, count - start))]
+
+
+def simulate_faults(cipher, plaintext, count, **kwargs):
+    """
+    Returns a list of `count` faulted outputs, see `simulate_batches` for the
+    fault options.
+    """
+    outputs = []
+    for batch in simulate_batches(cipher, plaintext, count, **kwargs):
+        outputs.extend(bytes(output) for output in batch)
+
+    return outputs
+
+
+def simulate_to_file(fname, cipher, plaintext, count, **kwargs):
+    """
+    Writes `count` faulted outputs to `fname` with one output per line (hex),
+    the format read by fault.py. Memory use is bounded by the batch size.
+    """
+    with open(fname, "w") as f:
+        for batch in simulate_batches(cipher, plaintext, count, **kwargs):
+            if np is not None:
+                digits = batch.tobytes().hex().upper()
+                lines = (digits[i : i + 32] for i in range(0, len(digits), 32))
+            else:
+                lines = (hex(output) for output in batch)
+
+            f.write("\n".join(lines))
+            f.write("\n")
@@ -1,5 +1,7 @@
 # Copyright @melkael
 
+import collections
+import struct
 from utils import hex
 
 E = [
@@ -429,7 +431,8 @@ def cutInHalves(v):
     return (v >> 32) & 0xFFFFFFFF, v & 0xFFFFFFFF
 
 
-def permutation(toPermute, table, inputSize, verbose=False):
+# Bit by bit permutation, the reference for the compiled ones
+def referencePermutation(toPermute, table, inputSize, verbose=False):
     res = 0
     for i in range(len(table)):
         mask = 1 << (inputSize - table[i])
@@ -440,12 +443,57 @@ def permutation(toPermute, table, inputSize, verbose=False):
     return res
 
 
+def compilePermutation(table, inputSize):
+    """
+    Compiles a permutation table into one lookup table per input byte, each
+    giving the output bits of the 256 values of its byte, so that a
+    permutation is a few lookups ORed together.
+
+    Input bit b (from the LSB) goes to the output bits of the entries equal
+    to inputSize - b. A zero entry reads bit inputSize, which is always clear
+    for inputs of inputSize bits: its output bit stays 0.
+    """
+    outputs = collections.defaultdict(int)
+    for i, entry in enumerate(table):
+        outputs[inputSize - entry] |= 1 << (len(table) - i - 1)
+
+    chunks = []
+    for shift in range(0, max(outputs) + 1, 8):
+        bits = [outputs[shift + b] for b in range(8)]
+        chunk = [0] * 256
+        for value in range(1, 256):
+            low = value & -value
+            chunk[value] = chunk[value ^ low] | bits[low.bit_length() - 1]
+        chunks.append((shift, chunk))
+
+    return chunks
+
+
+# Compiled permutations, by table and input size
+compiledPermutations = {}
+
+
+def permutation(toPermute, table, inputSize, verbose=False):
+    if verbose is True:
+        return referencePermutation(toPermute, table, inputSize, verbose)
+
+    key = (tuple(table), inputSize)
+    chunks = compiledPermutations.get(key)
+    if chunks is None:
+        chunks = compiledPermutations[key] = compilePermutation(table, inputSize)
+
+    res = 0
+    for shift, chunk in chunks:
+        res |= chunk[(toPermute >> shift) & 0xFF]
+    return res
+
+
 def expansion(inputMessage):
     return permutation(inputMessage, E, 32)
 
 
 def rotate(X):
-    poidsFort = 1 if X > pow(2, 27) else 0
+    poidsFort = (X >> 27) & 1
     X = X << 1
     X = (X & 0x0FFFFFFF) | poidsFort
     return X
@@ -597,7 +645,43 @@ Pinv = [
 ]
 
 
+# SP[i][block] is the 6-bit block of the ith Sbox going through the Sbox and
+# then P, so that F only needs 8 lookups and ORs.
+def makeSPTables():
+    tables = []
+    for i in range(8):
+        table = []
+        for block in range(64):
+            line = ((block & 0b100000) >> 4) | (block & 1)
+            column = (block & 0b011110) >> 1
+            table.append(permutation(Sbox[i][line][column] << (28 - i * 4), P, 32))
+        tables.append(table)
+    return tables
+
+
+SP = makeSPTables()
+
+
 def F(R, sousCle):
+    # E copies the bits around each 4-bit nibble of R, with R32 before R1 and
+    # R1 after R32: the 6-bit blocks are windows of R rotated into 34 bits.
+    R &= 0xFFFFFFFF
+    X = ((R & 1) << 33) | (R << 1) | (R >> 31)
+
+    return (
+        SP[0][((X >> 28) ^ (sousCle >> 42)) & 0x3F]
+        | SP[1][((X >> 24) ^ (sousCle >> 36)) & 0x3F]
+        | SP[2][((X >> 20) ^ (sousCle >> 30)) & 0x3F]
+        | SP[3][((X >> 16) ^ (sousCle >> 24)) & 0x3F]
+        | SP[4][((X >> 12) ^ (sousCle >> 18)) & 0x3F]
+        | SP[5][((X >> 8) ^ (sousCle >> 12)) & 0x3F]
+        | SP[6][((X >> 4) ^ (sousCle >> 6)) & 0x3F]
+        | SP[7][(X ^ sousCle) & 0x3F]
+    )
+
+
+# Bit by bit F, the reference for the SP-tables one
+def referenceF(R, sousCle):
     # after expansion, R is 48 bits long
     T = expansion(R) ^ sousCle
 
@@ -619,27 +703,121 @@ def F(R, sousCle):
     return permutation(res, P, 32)
 
 
-def DES(clear, K, fault_round=100, bit_index=0):
-    # Derivating K into 16 subkeys
-    subKeys = keySchedule(K)
+# Fault-free Feistel state before round `round`, see `checkpoint`.
+Checkpoint = collections.namedtuple("Checkpoint", ["round", "L", "R", "subKeys"])
+
 
-    # Inital Permutation, IP
-    clearIP = permutation(clear, IP, 64)
-    L, R = cutInHalves(clearIP)
+def checkpoint(clear, K, fault_round):
+    """
+    Runs the key schedule, IP and the rounds before `fault_round` once, and
+    returns the state as a lightweight snapshot that `resume` can finish
+    many times.
+    """
+    return DESCipher(K).checkpoint(clear, fault_round)
 
-    # 1 Feistel round/subkey
-    for i, sub in enumerate(subKeys):
-        # flip a single bit
-        if i == fault_round:
-            R ^= 1 << bit_index
 
-        LiPlus1 = R
-        RiPlus1 = L ^ F(R, sub)
+def resume(snapshot, bit_index=None):
+    """
+    Finishes an encryption from a `checkpoint` snapshot, first flipping bit
+    `bit_index` of R if given.
+    """
+    L, R = snapshot.L, snapshot.R
 
-        L = LiPlus1
-        R = RiPlus1
+    # flip a single bit
+    if bit_index is not None:
+        R ^= 1 << bit_index
+
+    L, R = feistel(L, R, snapshot.subKeys[snapshot.round :])
 
     # swap R16 and L16
     swapped = (R << 32) | L
     # apply IP^-1
     return permutation(swapped, IPinv, 64)
+
+
+# Runs 1 Feistel round per subkey
+def feistel(L, R, subKeys):
+    for sub in subKeys:
+        L, R = R, L ^ F(R, sub)
+
+    return L, R
+
+
+class DESCipher:
+    """
+    DES with a fixed key, whose 16 subkeys are only derived once. Blocks are
+    64-bit ints, like for `DES`.
+    """
+
+    def __init__(self, K):
+        # Derivating K into 16 subkeys
+        self.subKeys = keySchedule(K)
+        self._decSubKeys = self.subKeys[::-1]
+
+    def encrypt_block(self, clear):
+        return self._process_block(clear, self.subKeys)
+
+    def decrypt_block(self, ciphered):
+        # The decryption is the encryption with the subkeys in reverse order
+        return self._process_block(ciphered, self._decSubKeys)
+
+    def _process_block(self, block, subKeys):
+        L, R = cutInHalves(permutation(block, IP, 64))
+        L, R = feistel(L, R, subKeys)
+        return permutation((R << 32) | L, IPinv, 64)
+
+    def encrypt_blocks(self, blocks):
+        """
+        Encrypts a batch of independent blocks (ECB, no padding).
+
+        `blocks` is an iterable of 64-bit ints, and the output a list of ints,
+        or a bytes-like object holding N big-endian 8-byte blocks, and the
+        output a bytearray for a bytearray, bytes otherwise.
+        """
+        return self._process_blocks(blocks, self.subKeys)
+
+    def decrypt_blocks(self, blocks):
+        """
+        Decrypts a batch of independent blocks (ECB, no padding).
+
+        Accepts and returns the same layouts as `encrypt_blocks`.
+        """
+        return self._process_blocks(blocks, self._decSubKeys)
+
+    def _process_blocks(self, blocks, subKeys):
+        if not isinstance(blocks, (bytes, bytearray, memoryview)):
+            return [self._process_block(block, subKeys) for block in blocks]
+
+        data = bytes(blocks)
+        assert len(data) % 8 == 0
+        n = len(data) // 8
+        out = struct.pack(f">{n}Q", *(self._process_block(block, subKeys) for block in struct.unpack(f">{n}Q", data)))
+
+        return bytearray(out) if isinstance(blocks, bytearray) else out
+
+    def checkpoint(self, clear, fault_round):
+        """
+        Runs IP and the rounds before `fault_round`, see `checkpoint`.
+        """
+        # Inital Permutation, IP
+        L, R = cutInHalves(permutation(clear, IP, 64))
+        L, R = feistel(L, R, self.subKeys[:fault_round])
+
+        return Checkpoint(fault_round, L, R, self.subKeys)
+
+    def encrypt_block_with_fault(self, clear, fault_round, bit_index):
+        """
+        Encrypts a block, flipping bit `bit_index` of R before round
+        `fault_round`.
+        """
+        return resume(self.checkpoint(clear, fault_round), bit_index)
+
+
+def DES(clear, K, fault_round=100, bit_index=0):
+    cipher = DESCipher(K)
+
+    # Faults after the last round are never injected
+    if fault_round >= len(cipher.subKeys):
+        return cipher.encrypt_block(clear)
+
+    return cipher.encrypt_block_with_fault(clear, fault_round, bit_index)
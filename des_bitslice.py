@@ -0,0 +1,216 @@
+import des
+import operator
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Bitsliced DES: bit b of many independent DES instances ("lanes") is packed
+# into one bit plane, a Python int whose bit i belongs to lane i. The bit
+# permutations are free (they only reorder the planes), and each S-box is a
+# boolean circuit of XOR, AND and OR run on all the lanes at once.
+#
+# Planes are indexed like the DES tables, from the MSB: plane 0 holds bit 1
+# of the tables, bit 63 of the ints.
+
+
+# Compiles the Sbox `i` into a circuit, as a list of (gate, a, b) over a list
+# of registers: registers 0 to 5 are the input planes (MSB first), 6 is the
+# all-zeros plane and 7 the all-ones plane, and every gate appends its result.
+# Returns the circuit and the registers of the 4 output bits (MSB first).
+#
+# Each output bit is split on its inputs from the MSB (Shannon expansion),
+# sharing the identical sub-functions, which are few once only a couple of
+# inputs are left.
+def compile_sbox(i):
+    circuit = []
+    zero, ones = 6, 7
+    registers = {}
+
+    def gate(op, a, b):
+        circuit.append((op, a, b))
+        return 8 + len(circuit) - 1
+
+    def build(table, var):
+        if not any(table):
+            return zero
+        if all(table):
+            return ones
+        if table in registers:
+            return registers[table]
+
+        half = len(table) // 2
+        f0, f1 = build(table[:half], var + 1), build(table[half:], var + 1)
+
+        if f0 == f1:
+            r = f0
+        elif (f0, f1) == (zero, ones):
+            r = var
+        elif (f0, f1) == (ones, zero):
+            r = gate(operator.xor, var, ones)
+        elif f0 == zero:
+            r = gate(operator.and_, var, f1)
+        elif f1 == ones:
+            r = gate(operator.or_, var, f0)
+        else:
+            # f0 ^ (x & (f0 ^ f1)) picks f1 where x is set, f0 elsewhere
+            r = gate(operator.xor, f0, gate(operator.and_, var, gate(operator.xor, f0, f1)))
+
+        registers[table] = r
+        return r
+
+    outputs = []
+    for bit in range(3, -1, -1):
+        table = []
+        for block in range(64):
+            line = ((block & 0b100000) >> 4) | (block & 1)
+            column = (block & 0b011110) >> 1
+            table.append((des.Sbox[i][line][column] >> bit) & 1)
+        outputs.append(build(tuple(table), 0))
+
+    return circuit, outputs
+
+
+SBOX_CIRCUITS = [compile_sbox(i) for i in range(8)]
+
+
+def run_sbox(i, inputs, ones):
+    circuit, outputs = SBOX_CIRCUITS[i]
+    registers = inputs + [0, ones]
+    append = registers.append
+    for op, a, b in circuit:
+        append(op(registers[a], registers[b]))
+
+    return [registers[r] for r in outputs]
+
+
+# Left rotations of the key halves before each round
+KEY_ROTATIONS = [1, 1, 2, 2, 2, 2, 2, 2, 1, 2, 2, 2, 2, 2, 2, 1]
+
+
+# The key schedule only moves bits around: SUBKEY_BITS[r][j] is the plane of
+# the key feeding bit j (from the MSB) of the subkey of round r.
+def subkey_bits():
+    sources = []
+    T = [i - 1 for i in des.PC1]
+    for n in KEY_ROTATIONS:
+        C, D = T[:28], T[28:]
+        T = C[n:] + C[:n] + D[n:] + D[:n]
+        sources.append([T[i - 1] for i in des.PC2])
+
+    return sources
+
+
+SUBKEY_BITS = subkey_bits()
+
+
+# Returns the 64 planes of a list of 64-bit ints, lane i holding values[i]
+def to_planes(values):
+    if np is not None and len(values) > 64:
+        values = np.array(values, dtype=np.uint64)
+        shifts = np.arange(63, -1, -1, dtype=np.uint64)[:, None]
+        bits = ((values[None, :] >> shifts) & np.uint64(1)).astype(np.uint8)
+        packed = np.packbits(bits, axis=1, bitorder="little")
+        return [int.from_bytes(row.tobytes(), "little") for row in packed]
+
+    planes = []
+    for plane in range(64):
+        shift = 63 - plane
+        bits = 0
+        for lane, value in enumerate(values):
+            bits |= ((value >> shift) & 1) << lane
+        planes.append(bits)
+
+    return planes
+
+
+# Returns the n 64-bit ints of 64 planes, see to_planes
+def from_planes(planes, n):
+    if np is not None and n > 64:
+        n_bytes = (n + 7) // 8
+        packed = np.frombuffer(b"".join(p.to_bytes(n_bytes, "little") for p in planes), dtype=np.uint8)
+        bits = np.unpackbits(packed.reshape(64, n_bytes), axis=1, count=n, bitorder="little")
+        shifts = np.arange(63, -1, -1, dtype=np.uint64)[:, None]
+        return [int(v) for v in np.bitwise_or.reduce(bits.astype(np.uint64) << shifts, axis=0)]
+
+    values = []
+    for lane in range(n):
+        value = 0
+        for plane in planes:
+            value = (value << 1) | ((plane >> lane) & 1)
+        values.append(value)
+
+    return values
+
+
+# Returns the 32 planes of the faults flipping bit bit_indices[i] (counted
+# from the LSB, as in des.resume) of R in lane i, None leaving the lane
+# unfaulted.
+def fault_planes(bit_indices):
+    planes = [0] * 32
+    for lane, bit_index in enumerate(bit_indices):
+        if bit_index is not None:
+            planes[31 - bit_index] |= 1 << lane
+
+    return planes
+
+
+def encrypt_planes(block_planes, key_planes, ones, fault_round=None, faults=None):
+    """
+    Encrypts the 64 planes of the blocks with the 64 planes of the keys, and
+    returns the 64 planes of the outputs. `ones` is the plane with every lane
+    set. A plane equal in every lane is 0 or `ones`, so that one key (or one
+    block) can be shared by all the lanes.
+
+    `faults`, the 32 planes of `fault_planes`, are flipped in R before round
+    `fault_round`, like des.resume does after des.checkpoint.
+    """
+    state = [block_planes[i - 1] for i in des.IP]
+    L, R = state[:32], state[32:]
+
+    for r in range(16):
+        if r == fault_round:
+            R = [plane ^ fault for plane, fault in zip(R, faults)]
+
+        sources = SUBKEY_BITS[r]
+        x = [R[des.E[j] - 1] ^ key_planes[sources[j]] for j in range(48)]
+
+        s = []
+        for i in range(8):
+            s += run_sbox(i, x[6 * i : 6 * i + 6], ones)
+
+        L, R = R, [L[j] ^ s[des.P[j] - 1] for j in range(32)]
+
+    swapped = R + L
+    return [swapped[i - 1] for i in des.IPinv]
+
+
+def constant_planes(value, ones):
+    return [ones if (value >> (63 - plane)) & 1 else 0 for plane in range(64)]
+
+
+def encrypt_blocks(blocks, K, fault_round=None, bit_indices=None):
+    """
+    Encrypts a list of 64-bit blocks under the key K in one bitsliced pass,
+    and returns the list of outputs. bit_indices, one per block (see
+    `fault_planes`), fault the encryptions before round `fault_round`.
+    """
+    ones = (1 << len(blocks)) - 1
+    faults = fault_planes(bit_indices) if fault_round is not None else None
+    out = encrypt_planes(to_planes(blocks), constant_planes(K, ones), ones, fault_round, faults)
+
+    return from_planes(out, len(blocks))
+
+
+def encrypt_keys(clear, keys, fault_round=None, bit_indices=None):
+    """
+    Encrypts the 64-bit block `clear` under each key of a list in one
+    bitsliced pass, and returns the list of outputs. Faults are injected like
+    for `encrypt_blocks`.
+    """
+    ones = (1 << len(keys)) - 1
+    faults = fault_planes(bit_indices) if fault_round is not None else None
+    out = encrypt_planes(constant_planes(clear, ones), to_planes(keys), ones, fault_round, faults)
+
+    return from_planes(out, len(keys))
@@ -1,6 +1,7 @@
 from utils import *
-import collections
+import itertools
 import des
+import des_bitslice
 
 
 # Find the sbox that the value will go through
@@ -11,95 +12,204 @@ def sbox_position(val):
     return row, col
 
 
-def is_solution(sbox_index, p, pos, faulted_pos):
-    msb = 32 - sbox_index * 4
-    row, col = pos
-    row_faulted, col_faulted = faulted_pos
+def sbox_output(sbox_index, val):
+    row, col = sbox_position(val)
 
-    a = extract(p, msb - 1, msb - 4)
-    b = des.Sbox[sbox_index][row][col] ^ des.Sbox[sbox_index][row_faulted][col_faulted]
+    return des.Sbox[sbox_index][row][col]
 
-    return a == b
 
+# SBOX_DIFFERENCES[i][x][y] is the output difference of the ith sbox for the
+# inputs x and y
+SBOX_DIFFERENCES = [
+    [[sbox_output(i, x) ^ sbox_output(i, y) for y in range(64)] for x in range(64)]
+    for i in range(8)
+]
 
-def recover_des_key(ref, faulted_outputs):
-    # sbox_used[i] is the list of faults where the faulted bits went through
-    # the ith sbox
-    sbox_used = [[] for _ in range(8)]
 
-    # fill up sbox_used
-    for fault_index, fault in enumerate(faulted_outputs):
-        diffs = compare(des_bytes(ref), des_bytes(fault))
-        dump_diff(des_bytes(ref), des_bytes(fault), diffs)
+# DIFFERENCE_INPUTS[i][d][a] is the 64-bit mask of the inputs x of the ith
+# sbox whose output changes by a when x changes by d
+def difference_inputs():
+    table = [[[0] * 16 for _ in range(64)] for _ in range(8)]
+    for i in range(8):
+        for x in range(64):
+            for d in range(64):
+                table[i][d][SBOX_DIFFERENCES[i][x][x ^ d]] |= 1 << x
+
+    return table
+
+
+DIFFERENCE_INPUTS = difference_inputs()
+
+
+# AFFECTED_SBOXES[b] is the mask of the sboxes (bit i for the ith sbox) that
+# the bit b of R15 (from the LSB) goes through after the expansion
+def affected_sboxes():
+    table = [0] * 32
+    for j, bit in enumerate(des.E):
+        table[32 - bit] |= 1 << (j // 6)
+
+    return table
+
+
+AFFECTED_SBOXES = affected_sboxes()
+
+# Masks of the low halves of the 2^j bit pairs, see xor_permute
+XOR_SWAPS = [
+    (1, 0x5555555555555555),
+    (2, 0x3333333333333333),
+    (4, 0x0F0F0F0F0F0F0F0F),
+    (8, 0x00FF00FF00FF00FF),
+    (16, 0x0000FFFF0000FFFF),
+    (32, 0x00000000FFFFFFFF),
+]
 
-        # We use the xor of the fault and the reference, because that allows
-        # us to compute the permutation, extraction and expansion only once.
-        # Any difference between the fault and the reference will show up as
-        # a set bit after xor.
-        # Without xor, we'd have to apply the transformations to both the
-        # fault and the reference and compare them.
-        x = fault ^ ref
-        # invert the final permutation
-        perm = des.permutation(x, des.IP, 64)
-        # invert the swap
-        perm = (perm >> 32) | ((perm & 0xFFFFFFFF) << 32)
-
-        R15 = extract(perm, 63, 32)
-
-        exp = des.expansion(R15)
-
-        # bits go through the sbox 6 by 6 (8 blocks)
-        # sbox[0] is used by the first block, starting from the MSB
-        for i in range(8):
-            msb = 48 - i * 6
-            block = extract(exp, msb - 1, msb - 6)
-            if block != 0:
-                sbox_used[i].append(fault_index)
 
-    KEY_SETS = [collections.Counter() for _ in range(8)]
+# Returns the 64-bit mask whose bit k is the bit k ^ c of mask
+def xor_permute(mask, c):
+    for j, (shift, low) in enumerate(XOR_SWAPS):
+        if (c >> j) & 1:
+            mask = ((mask >> shift) & low) | ((mask & low) << shift)
+
+    return mask
+
+
+# Counts the votes of 64-bit masks for each of their 64 bits at once:
+# counters[l] holds the bit l of the 64 counts, and adding a mask ripples the
+# carries through them.
+class MaskVotes:
+    def __init__(self):
+        self.counters = []
+
+    def add(self, mask):
+        for level, counter in enumerate(self.counters):
+            if not mask:
+                return
+            self.counters[level], mask = counter ^ mask, counter & mask
+        if mask:
+            self.counters.append(mask)
+
+    def counts(self):
+        return [sum(((c >> k) & 1) << l for l, c in enumerate(self.counters)) for k in range(64)]
+
+
+# Only that many faults are dumped, the analysis of large campaigns would
+# otherwise be spent printing
+MAX_DUMPED_FAULTS = 64
+
+
+# Returns the ranked key candidates of each sbox, as lists of (6-bit key,
+# votes) pairs, best first: the 64 keys of an sbox, ties in key order, or
+# only its key for a sbox of known_sboxes.
+#
+# known_sboxes pins the 6-bit keys of the sboxes already known, e.g. from an
+# earlier session, as a dict of sbox index to key. These sboxes are not
+# analysed, and the faults only going through them are dropped.
+#
+# For the sbox i, a key guess k survives a fault if the sbox turns the
+# difference of its R15 inputs x ^ k and x_faulted ^ k into the difference of
+# L16 (before P): each fault narrows down to a 64-bit mask of surviving keys
+# per sbox, looked up in DIFFERENCE_INPUTS, and the masks vote.
+def des_key_candidates(ref, faulted_outputs, known_sboxes=None):
+    known_sboxes = known_sboxes or {}
+    assert all(0 <= i < 8 and 0 <= k < 64 for i, k in known_sboxes.items())
+    known_mask = sum(1 << i for i in known_sboxes)
 
     pref = des.permutation(ref, des.IP, 64)
     L16 = extract(pref, 63, 32)
     R15 = extract(pref, 31, 0)
     R15_expanded = des.expansion(R15)
+    chunks = [extract(R15_expanded, 47 - i * 6, 42 - i * 6) for i in range(8)]
+
+    votes = [MaskVotes() for _ in range(8)]
+    n_analysed = 0
+    n_pinned = 0
+
+    for fault in faulted_outputs:
+        pfault = des.permutation(fault, des.IP, 64)
+
+        # We use the xor of the fault and the reference, because that allows
+        # us to compute the permutation and expansion only once.
+        R15_diff = extract(pfault, 31, 0) ^ R15
+
+        used = 0
+        bits = R15_diff
+        while bits:
+            low = bits & -bits
+            used |= AFFECTED_SBOXES[low.bit_length() - 1]
+            bits ^= low
+
+        if used and used & ~known_mask == 0:
+            n_pinned += 1
+            continue
+
+        if n_analysed < MAX_DUMPED_FAULTS:
+            diffs = compare(des_bytes(ref), des_bytes(fault))
+            dump_diff(des_bytes(ref), des_bytes(fault), diffs)
+        n_analysed += 1
+
+        used &= ~known_mask
+        if not used:
+            continue
+
+        p = des.permutation(L16 ^ extract(pfault, 63, 32), des.Pinv, 32)
+        exp_diff = des.expansion(R15_diff)
+
+        for i in range(8):
+            if (used >> i) & 1:
+                d = extract(exp_diff, 47 - i * 6, 42 - i * 6)
+                a = extract(p, 31 - i * 4, 28 - i * 4)
+                votes[i].add(xor_permute(DIFFERENCE_INPUTS[i][d][a], chunks[i]))
+
+    if n_analysed > MAX_DUMPED_FAULTS:
+        print(f"... {n_analysed - MAX_DUMPED_FAULTS} more faults")
+    if n_pinned:
+        print(f"Dropped {n_pinned} faults of known sboxes")
+
+    candidates = []
 
     for sbox_index in range(8):
-        print(f"Analysing sbox {sbox_index}")
-        for fault_index in sbox_used[sbox_index]:
-            fault = faulted_outputs[fault_index]
-            pfault = des.permutation(fault, des.IP, 64)
+        if sbox_index in known_sboxes:
+            print(f"Sbox {sbox_index}: known")
+            candidates.append([(known_sboxes[sbox_index], 0)])
+            continue
+
+        counts = votes[sbox_index].counts()
+        ranked = sorted(enumerate(counts), key=lambda candidate: -candidate[1])
+        candidates.append(ranked)
+        if ranked[0][1]:
+            print(f"Sbox {sbox_index}: margin {sbox_margin(ranked)}")
+        else:
+            print(f"Sbox {sbox_index}: no fault")
 
-            L16_faulted = extract(pfault, 63, 32)
-            R15_faulted = extract(pfault, 31, 0)
-            p = des.permutation(L16 ^ L16_faulted, des.Pinv, 32)
+    return candidates
 
-            R15_faulted_expanded = des.expansion(R15_faulted)
 
-            for k in range(64):
-                msb = 48 - sbox_index * 6
+# Returns the vote difference between the best key of a sbox and the
+# runner-up, see des_key_candidates
+def sbox_margin(candidates):
+    return candidates[0][1] - (candidates[1][1] if len(candidates) > 1 else 0)
 
-                chunk = extract(R15_expanded, msb - 1, msb - 6)
-                chunk ^= k
-                pos = sbox_position(chunk)
 
-                chunk_faulted = extract(R15_faulted_expanded, msb - 1, msb - 6)
-                chunk_faulted ^= k
-                faulted_pos = sbox_position(chunk_faulted)
+# Returns the last round key made of the best key of each sbox
+def best_des_key(candidates):
+    return combination_des_key(candidates, [0] * 8)
 
-                if is_solution(sbox_index, p, pos, faulted_pos):
-                    KEY_SETS[sbox_index][k] += 1
 
-    # In theory, the most common value should be the correct value.
-    # We could also choose the only value common to all guesses on an sbox,
-    # but I like this better.
+def combination_des_key(candidates, ranks):
     key = 0
-    for i in range(8):
-        best = KEY_SETS[7 - i].most_common(1)[0][0]
-        key |= best << (6 * i)
+    for i, rank in enumerate(ranks):
+        key |= candidates[i][rank][0] << (6 * (7 - i))
 
     return key
 
 
+# In theory, the most voted key of each sbox should be the correct one.
+# We could also choose the only value common to all guesses on an sbox,
+# but I like this better.
+def recover_des_key(ref, faulted_outputs, known_sboxes=None):
+    return best_des_key(des_key_candidates(ref, faulted_outputs, known_sboxes))
+
+
 # Apply parity bits to a naked DES key
 def apply_parity(k):
     for i in range(8):
@@ -130,17 +240,57 @@ def make_missing_bit_mask(guess):
 # Luckily, DES keys are really only 56 bits large, because they include 8
 # parity bits.
 # We bruteforce the 8 missing bits that are not parity bits.
-def recover_initial_des_key(k, clear, ref):
+def initial_des_key_candidates(k):
     base_key = des.permutation(des.permutation(k, des.PC2inv, 48), des.PC1inv, 56)
 
-    for guess in range(256):
-        candidate_k = base_key | make_missing_bit_mask(guess)
+    return [base_key | make_missing_bit_mask(guess) for guess in range(256)]
+
 
+# Returns the initial key among candidates encrypting clear to ref, or None.
+# The candidates are encrypted at once by the bitsliced engine.
+def find_initial_des_key(candidates, clear, ref):
+    for candidate_k, output in zip(candidates, des_bitslice.encrypt_keys(clear, candidates)):
         # Applying the parity before encryption is not necessary, because the
         # bits are not used in DES.
         # We apply the parity after finding the correct key because the
         # user is likely to expect a key with parity bits.
-        if ref == des.DES(clear, candidate_k):
+        if ref == output:
             return apply_parity(candidate_k)
 
     return None
+
+
+def recover_initial_des_key(k, clear, ref):
+    return find_initial_des_key(initial_des_key_candidates(k), clear, ref)
+
+
+# Last round keys completed per bitsliced pass by search_initial_des_key,
+# with 256 lanes each
+DES_SEARCH_BATCH_SIZE = 16
+
+
+# Tries the last round keys made of the sbox candidates (see
+# des_key_candidates) in decreasing order of votes, until one of them
+# completes into an initial key encrypting clear to ref, which is returned.
+# Gives up after max_tries last round keys and returns None.
+def search_initial_des_key(candidates, clear, ref, max_tries=1 << 12):
+    combinations = ranked_combinations(candidates)
+    tries = 0
+
+    while tries < max_tries:
+        batch = list(itertools.islice(combinations, min(DES_SEARCH_BATCH_SIZE, max_tries - tries)))
+        if not batch:
+            break
+
+        initial_keys = []
+        for ranks, _ in batch:
+            initial_keys += initial_des_key_candidates(combination_des_key(candidates, ranks))
+
+        key = find_initial_des_key(initial_keys, clear, ref)
+        tries += len(batch)
+        if key is not None:
+            print(f"Tried {tries} last round keys")
+            return key
+
+    print(f"Tried {tries} last round keys")
+    return None
@@ -39,22 +39,30 @@ def main():
 
     if args.aes:
         aes_cipher = aes.AES(k)
+    else:
+        des_cipher = des.DESCipher(k)
 
     if args.plaintext:
         p = tr(args.plaintext)
         if args.aes:
             print(f"{hex(aes_cipher.encrypt_block(p))}")
         else:
-            print(f"{hex(des.DES(p, k))}")
+            print(f"{hex(des_cipher.encrypt_block(p))}")
 
     if args.plaintext_file:
         with open(args.plaintext_file, "r") as f:
-            for line in f.readlines():
-                p = tr(line.rstrip())
-                if args.aes:
-                    print(f"{hex(aes_cipher.encrypt_block(p))}")
-                else:
-                    print(f"{hex(des.DES(p, k))}")
+            plaintexts = [tr(line.rstrip()) for line in f.readlines()]
+
+        if args.aes:
+            # Encrypt the whole file in one batch
+            assert all(len(p) == 16 for p in plaintexts)
+            ciphertexts = aes_cipher.encrypt_blocks(b"".join(plaintexts))
+            for i in range(0, len(ciphertexts), 16):
+                print(f"{hex(ciphertexts[i:i + 16])}")
+        else:
+            # The subkeys are only derived once for the whole file
+            for c in des_cipher.encrypt_blocks(plaintexts):
+                print(f"{hex(c)}")
 
 
 if __name__ == "__main__":
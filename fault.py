@@ -3,8 +3,23 @@
 import binascii
 import aes
 import des
-from aes_recover import recover_aes_key
-from des_recover import recover_des_key, recover_initial_des_key
+import des_bitslice
+from aes_recover import (
+    MAX_FAULTED_BYTES,
+    SCORING_MODES,
+    AESRecovery,
+    recover_aes_key_pairs,
+    recover_aes_master_key_pairs,
+    recover_round8_key_pairs,
+)
+from aes_simulate import FAULT_TYPES, simulate_to_file
+from des_recover import (
+    best_des_key,
+    des_key_candidates,
+    recover_des_key,
+    recover_initial_des_key,
+    search_initial_des_key,
+)
 from utils import hex
 import random
 import sys
@@ -21,6 +36,50 @@ def read_faults(fname, tr):
     return output
 
 
+# AES fault files have one faulted output per line (hex), optionally preceded
+# by the non faulted output of its plaintext ("ref faulted", separated by a
+# space or a comma). Lines without a reference use `ref`.
+# Returns the list of (ref, faulted output) pairs of all the files.
+def read_aes_pairs(fnames, ref):
+    pairs = []
+
+    for fname in fnames:
+        for line in read_faults(fname, lambda x: x.replace(",", " ").split()):
+            if not line:
+                continue
+            if len(line) == 1:
+                if ref is None:
+                    raise ValueError(f"{fname}: --ref is needed for faults without a reference")
+                pairs.append((ref, binascii.unhexlify(line[0])))
+            else:
+                pairs.append((binascii.unhexlify(line[0]), binascii.unhexlify(line[1])))
+
+    return pairs
+
+
+# Parses the --known entries "INDEX=HEX": an AES column and its 4 key bytes in
+# the FAULT_DESTINATION order (8 hex digits), or a DES sbox and its 6-bit key.
+# Returns a dict of index to key.
+def parse_known(entries, is_aes):
+    known = {}
+
+    for entry in entries or []:
+        index, _, value = entry.partition("=")
+        try:
+            index = int(index)
+            value = binascii.unhexlify(value) if is_aes else int(value, 16)
+        except (ValueError, binascii.Error):
+            raise ValueError(f"Invalid --known entry: {entry}")
+
+        if is_aes and not (0 <= index < 4 and len(value) == 4):
+            raise ValueError(f"--known AES columns are 0 to 3 with 4 key bytes: {entry}")
+        if not is_aes and not (0 <= index < 8 and 0 <= value < 64):
+            raise ValueError(f"--known DES sboxes are 0 to 7 with a 6-bit key: {entry}")
+        known[index] = value
+
+    return known
+
+
 def artificial_aes():
     PLAINTEXT = binascii.unhexlify("000102030405060708090a0b0c0d0e0f")
     KEY = binascii.unhexlify("bf05bd81f5497eef74dae9478eead746")
@@ -38,44 +97,75 @@ def artificial_aes():
     ref = cipher.encrypt_block(PLAINTEXT)
     print(f"ref: {hex(ref)}")
 
-    outputs = []
+    recovery = AESRecovery(ref)
 
-    # 8 faults are enough in this super simple case
-    for i in range(8):
+    # Fault until every column of the key is known, 8 faults are enough in
+    # this super simple case
+    i = 0
+    while not recovery.converged:
         faulted = cipher.encrypt_block_with_fault(
             PLAINTEXT,
             i % 4,
             0,
             i,
         )
-        outputs.append(faulted)
-        print(f"{hex(faulted)}")
+        recovery.add_fault(faulted)
+        print(f"{hex(faulted)} {recovery.status()}")
+        i += 1
 
-    k = recover_aes_key(ref, outputs)
+    k = recovery.key()
 
     print(f"Recovered round 10 key: {hex(k)}")
     assert hex(k) == hex(cipher._key_matrices[-1])
     print(f"SUCCESS")
 
 
-def real_aes(ref, faults):
-    k = recover_aes_key(ref, faults)
+def real_aes(pairs, scoring, max_faulted_bytes, known):
+    k = recover_aes_key_pairs(pairs, scoring, max_faulted_bytes, known)
     print(f"Recoved round 10 key: {hex(k)}")
 
 
+def reverse_aes(final_key, plain, ref):
+    k = aes.reverse_key_schedule(final_key)
+    print(f"Round 0 AES key: {hex(k)}")
+    if plain and ref:
+        if aes.AES(k).encrypt_block(plain) == ref:
+            print("The key encrypts the plaintext to the reference output")
+        else:
+            print("The key doesn't encrypt the plaintext to the reference output")
+
+
+def search_aes(pairs, plain, ref, scoring, max_faulted_bytes, tries, known):
+    k = recover_aes_master_key_pairs(pairs, plain, ref, scoring, max_faulted_bytes, tries, known)
+    if k is None:
+        print("Couldn't find a matching AES round 0 key")
+    else:
+        print(f"Round 0 AES key: {hex(k)}")
+
+
+def real_aes_round8(pairs, workers, known):
+    keys = recover_round8_key_pairs(pairs, workers, known)
+    if not keys:
+        print("No round 10 key matches the round 8 faults")
+    elif len(keys) == 1:
+        print(f"Recovered round 10 key: {hex(keys[0])}")
+    else:
+        print(f"{len(keys)} round 10 key candidates:")
+        for k in keys:
+            print(hex(k))
+
+
 def artificial_des():
     PLAINTEXT = 0x0102030405060708
     KEY = 0x1C8529CEA240AE4F
 
     ref = des.DES(PLAINTEXT, KEY)
 
-    outputs = []
-
-    for i in range(32):
-        r = 15
-        print(f"Faulting at round {r}")
-        faulted = des.DES(PLAINTEXT, KEY, r, i % 32)
-        outputs.append(faulted)
+    # Flip each bit of R before the last round, the 32 faulted encryptions
+    # running in one bitsliced pass
+    r = 15
+    print(f"Faulting at round {r}")
+    outputs = des_bitslice.encrypt_blocks([PLAINTEXT] * 32, KEY, r, [i % 32 for i in range(32)])
 
     k = recover_des_key(ref, outputs)
 
@@ -89,11 +179,13 @@ def artificial_des():
     assert real_k == KEY
 
 
-def real_des(plain, ref, faults):
-    k = recover_des_key(ref, faults)
+def real_des(plain, ref, faults, known, tries):
+    candidates = des_key_candidates(ref, faults, known)
+    k = best_des_key(candidates)
     print(f"Recovered round key: {hex(k)}")
     if plain:
-        real_k = recover_initial_des_key(k, plain, ref)
+        # The best round key is tried first, then the next ones by votes
+        real_k = search_initial_des_key(candidates, plain, ref, tries)
         if real_k is None:
             print("Couldn't find the initial key")
         else:
@@ -102,7 +194,63 @@ def real_des(plain, ref, faults):
         print("No plaintext supplied, can't recover the initial key (--plain)")
 
 
+def simulate(argv):
+    parser = argparse.ArgumentParser(
+        prog="fault.py simulate", description="AES fault campaign simulation"
+    )
+
+    parser.add_argument("--key", help="Encryption key (hex)", type=str, required=True)
+    parser.add_argument("--plain", help="Plaintext (hex)", type=str, required=True)
+    parser.add_argument(
+        "--count", help="Number of faulted outputs", type=int, required=True
+    )
+    parser.add_argument(
+        "--output", help="File to write the faulted outputs to", type=str, required=True
+    )
+    parser.add_argument(
+        "--round",
+        help="Round whose MixColumns input is faulted (default: 9)",
+        type=int,
+        default=9,
+    )
+    parser.add_argument(
+        "--position",
+        help="Faulted state byte, 4 * column + row (default: random)",
+        type=int,
+    )
+    parser.add_argument(
+        "--type", help="Fault model", choices=FAULT_TYPES, default="set"
+    )
+    parser.add_argument(
+        "--value", help="Value written by 'set' faults (hex, default: random)", type=str
+    )
+    parser.add_argument("--seed", help="Random seed", type=int)
+
+    args = parser.parse_args(argv)
+
+    cipher = aes.AES(binascii.unhexlify(args.key))
+    plain = binascii.unhexlify(args.plain)
+    print(f"ref: {hex(cipher.encrypt_block(plain))}")
+
+    simulate_to_file(
+        args.output,
+        cipher,
+        plain,
+        args.count,
+        fault_round=args.round,
+        position=args.position,
+        fault_type=args.type,
+        value=int(args.value, 16) if args.value else None,
+        seed=args.seed,
+    )
+    print(f"Wrote {args.count} faulted outputs to {args.output}")
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "simulate":
+        simulate(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(description="AES and DES fault analysis")
 
     parser.add_argument(
@@ -113,13 +261,14 @@ def main():
     )
     parser.add_argument(
         "--faults",
-        help="File with one faulted output per line (hex)",
+        help="Files with one faulted output per line (hex), AES lines may be "
+        "prefixed by their own non faulted output",
+        nargs="+",
         type=str,
     )
     parser.add_argument(
         "--ref",
         help="Non faulted output for the plaintext (hex)",
-        required=True,
         type=str,
     )
     parser.add_argument(
@@ -127,15 +276,53 @@ def main():
         help="Plaintext that produces the reference output (hex)",
         type=str,
     )
+    parser.add_argument(
+        "--scoring",
+        help="AES key candidate scoring (default: votes)",
+        choices=SCORING_MODES,
+        default="votes",
+    )
+    parser.add_argument(
+        "--faulted-bytes",
+        help="Maximum number of bytes of a column hit by an AES fault (default: 1)",
+        type=int,
+        choices=range(1, MAX_FAULTED_BYTES + 1),
+        default=1,
+    )
+    parser.add_argument(
+        "--round8",
+        help="AES faults were injected before the round 8 MixColumns",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--workers",
+        help="Processes for the AES round 8 search (default: one per CPU)",
+        type=int,
+    )
+    parser.add_argument(
+        "--known",
+        help="Known parts of the last round key, as INDEX=HEX: an AES column "
+        "(0-3) and its 4 key bytes, or a DES sbox (0-7) and its 6-bit key",
+        nargs="+",
+        type=str,
+    )
     parser.add_argument(
         "--reverse",
-        help="Reverse the key schedule from a final round key",
+        help="Reverse the key schedule from a final round key, or for AES "
+        "from the best round 10 keys of the faults",
         default=False,
         action="store_true",
     )
     parser.add_argument(
         "--final-key", help="The final round key for --reverse", type=str
     )
+    parser.add_argument(
+        "--tries",
+        help="Last round keys tried by AES --reverse without --final-key "
+        "(default: 2^20), or by DES with --plain (default: 2^12)",
+        type=int,
+    )
 
     args = parser.parse_args()
 
@@ -145,39 +332,65 @@ def main():
     if args.des and args.aes:
         print("Can't combine --aes and --des.")
         return
-    if args.aes and args.reverse:
-        print("AES key schedule reverse not supported")
-        return
     if not args.reverse and not args.faults:
         print("--faults is required when not using --reverse")
         return
+    if args.des and not args.ref:
+        print("--ref is required for DES")
+        return
     if args.reverse:
-        if not args.final_key:
+        if args.des and not args.final_key:
             print("--reverse needs --final-key")
             return
         if args.des and not args.plain:
             print("DES --reverse needs --plaintext")
             return
+        if args.aes and not args.final_key and not (args.faults and args.plain and args.ref):
+            print("AES --reverse needs --final-key, or --faults, --plain and --ref")
+            return
 
-    if args.reverse:
-        if args.des:
-            plain = int(args.plain, 16)
-            k = int(args.final_key, 16)
-            ref = int(args.ref, 16)
-            init_k = recover_initial_des_key(k, plain, ref)
-            if init_k is not None:
-                print(f"Round 0 DES key: {hex(init_k)}")
-            else:
-                print("Couldn't find a matching DES round 0 key")
+    if args.reverse and args.des:
+        plain = int(args.plain, 16)
+        k = int(args.final_key, 16)
+        ref = int(args.ref, 16)
+        init_k = recover_initial_des_key(k, plain, ref)
+        if init_k is not None:
+            print(f"Round 0 DES key: {hex(init_k)}")
+        else:
+            print("Couldn't find a matching DES round 0 key")
+    elif args.reverse and args.final_key:
+        plain = binascii.unhexlify(args.plain) if args.plain else None
+        ref = binascii.unhexlify(args.ref) if args.ref else None
+        reverse_aes(binascii.unhexlify(args.final_key), plain, ref)
     elif args.aes:
-        faults = read_faults(args.faults, lambda x: binascii.unhexlify(x))
-        ref = binascii.unhexlify(args.ref)
-        real_aes(ref, faults)
+        ref = binascii.unhexlify(args.ref) if args.ref else None
+        try:
+            pairs = read_aes_pairs(args.faults, ref)
+            known = parse_known(args.known, True)
+        except ValueError as e:
+            print(e)
+            return
+        if args.reverse:
+            plain = binascii.unhexlify(args.plain)
+            tries = args.tries if args.tries is not None else 1 << 20
+            search_aes(pairs, plain, ref, args.scoring, args.faulted_bytes, tries, known)
+        elif args.round8:
+            real_aes_round8(pairs, args.workers, known)
+        else:
+            real_aes(pairs, args.scoring, args.faulted_bytes, known)
     else:
-        faults = read_faults(args.faults, lambda x: int(x, 16))
+        try:
+            known = parse_known(args.known, False)
+        except ValueError as e:
+            print(e)
+            return
+        faults = []
+        for fname in args.faults:
+            faults += read_faults(fname, lambda x: int(x, 16))
         ref = int(args.ref, 16)
         plain = int(args.plain, 16) if args.plain else None
-        real_des(plain, ref, faults)
+        tries = args.tries if args.tries is not None else 1 << 12
+        real_des(plain, ref, faults, known, tries)
 
 
 if __name__ == "__main__":
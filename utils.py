@@ -1,5 +1,6 @@
 import binascii
 import builtins
+import heapq
 
 def _hex(b):
     if type(b) == list:
@@ -85,3 +86,28 @@ def extract(x, msb, lsb):
 
 def set_bit(x, idx):
     return x | (1 << idx)
+
+
+# Yields (ranks, score) pairs in decreasing order of score, where ranks are the
+# ranks of one candidate of each column and score the sum of their scores.
+# `columns` holds the ranked (candidate, score) pairs of each column, e.g. the
+# AES key columns of AESRecovery.candidates.
+def ranked_combinations(columns):
+    scores = [[score for _, score in candidates] for candidates in columns]
+    if not all(scores):
+        return
+
+    # Every combination is pushed once, by the combination with the rank of
+    # its last non zero column decremented, which has a higher score.
+    heap = [(-sum(column_scores[0] for column_scores in scores), (0,) * len(columns), 0)]
+
+    while heap:
+        negated_score, ranks, last = heapq.heappop(heap)
+        yield ranks, -negated_score
+
+        for column in range(last, len(columns)):
+            rank = ranks[column] + 1
+            if rank < len(scores[column]):
+                successor = ranks[:column] + (rank,) + ranks[column + 1 :]
+                successor_score = negated_score + scores[column][rank - 1] - scores[column][rank]
+                heapq.heappush(heap, (successor_score, successor, column))